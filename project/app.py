@@ -1,30 +1,106 @@
 import asyncio
+import functools
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
+import re
 import time
 import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, AsyncGenerator
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple, AsyncGenerator
 
 import aiohttp
-import requests
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile, Query
+import numpy as np
+import orjson
+from PIL import Image
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.background import BackgroundTasks
 
-from utils.image_utils import preprocess_image
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - optional dependency, only needed with REDIS_URL
+    aioredis = None
+
+from utils.batch_utils import MicroBatcher
+from utils.cache_utils import TTLCache
+from utils.image_utils import preprocess_image_stream, read_image_size
 from utils.ocr_utils import (
     extract_text_easyocr,
     extract_text_tesseract,
     extract_text_paddleocr,
+    cuda_available,
+    easyocr_shared_images_batched,
+    init_ocr_worker,
+    ocr_shared_image,
+    warm_up_easyocr_batched,
 )
+from utils.rate_limit_utils import RateLimiter
 
 # ===== CONFIGURATION =====
 OLLAMA_API_BASE_URL = os.getenv("OLLAMA_API_BASE_URL", "http://localhost:11434")
 PROMPT_PATH = Path(__file__).parent / "prompts" / "check_prompt.txt"
+# ${name} placeholders in the prompt template, filled per request by build_prompt
+PROMPT_PLACEHOLDER_PATTERN = re.compile(r"\$\{(\w+)\}")
+PROMPT_FIELDS = ("ocr_text",)
+# Development aid: pick up edits to the prompt file without restarting the server
+PROMPT_RELOAD = os.getenv("PROMPT_RELOAD", "false").lower() in ("1", "true", "yes")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Max seconds to wait for the next streamed chunk before a model is considered stalled
+OLLAMA_CHUNK_TIMEOUT = int(os.getenv("OLLAMA_CHUNK_TIMEOUT", "120"))
+# Max in-flight generate calls per Ollama host; Ollama mostly runs one model at a time
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "1"))
+# Minimum seconds between the starts of two generate calls to one Ollama host (0 disables)
+OLLAMA_MIN_INTERVAL = float(os.getenv("OLLAMA_MIN_INTERVAL", "0"))
+# Attempts per generate call; connection errors and overload/rate-limit responses are retried
+# with exponential backoff (1s, 2s, 4s, ... capped at 8s)
+OLLAMA_MAX_ATTEMPTS = max(1, int(os.getenv("OLLAMA_MAX_ATTEMPTS", "3")))
+OLLAMA_RETRY_BASE_DELAY = 1.0
+OLLAMA_RETRY_MAX_DELAY = 8.0
+OLLAMA_RETRY_STATUSES = {429, 502, 503, 504}
+# How long Ollama keeps a model loaded after a call, so the next check skips the model load
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "10m")
+# Optional context window; a fixed value avoids reloading the model when it differs between calls
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "0")) or None
+# Comma-separated models loaded into Ollama at startup
+OLLAMA_PREWARM_MODELS = [m.strip() for m in os.getenv("OLLAMA_PREWARM_MODELS", "").split(",") if m.strip()]
+# "fast": run Tesseract first and only run EasyOCR/PaddleOCR when its output is weak
+# "thorough": always wait for all three OCR engines
+OCR_STRATEGY = os.getenv("OCR_STRATEGY", "fast").lower()
+OCR_MIN_CHARS = int(os.getenv("OCR_MIN_CHARS", "40"))
+OCR_MIN_DIGITS = int(os.getenv("OCR_MIN_DIGITS", "6"))
+# High-quality preprocessing (NLM denoising, Gaussian thresholding, bicubic deskew); better on
+# very noisy scans, but tens of times slower
+OCR_HIGH_QUALITY_DENOISE = os.getenv("OCR_HIGH_QUALITY_DENOISE", "false").lower() in ("1", "true", "yes")
+# Concurrent checks are OCR'd by EasyOCR in batches of up to this many images (1 disables
+# batching); worthwhile on GPU hosts under steady load
+EASYOCR_BATCH_SIZE = max(1, int(os.getenv("EASYOCR_BATCH_SIZE", "1")))
+EASYOCR_BATCH_WAIT_MS = int(os.getenv("EASYOCR_BATCH_WAIT_MS", "20"))
+TESSERACT_WORKERS = max(1, int(os.getenv("TESSERACT_WORKERS", str(os.cpu_count() or 1))))
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "256"))
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", "3600"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# Room for the multipart boundaries and the other form fields on top of the image itself
+MAX_REQUEST_OVERHEAD_BYTES = 64 * 1024
+HASH_CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_PIXELS = int(float(os.getenv("MAX_IMAGE_MEGAPIXELS", "40")) * 1_000_000)
+PROGRESS_MAX_SESSIONS = int(os.getenv("PROGRESS_MAX_SESSIONS", "2048"))
+PROGRESS_SESSION_TTL = int(os.getenv("PROGRESS_SESSION_TTL", "3600"))
+# Finished sessions only need to stay around long enough for clients to fetch the result
+PROGRESS_FINISHED_TTL = int(os.getenv("PROGRESS_FINISHED_TTL", "600"))
+PROGRESS_MAX_LOGS = 500
+# Optional shared progress store so any uvicorn worker can serve progress for any session
+REDIS_URL = os.getenv("REDIS_URL")
 
 # ===== LOGGING SETUP =====
 logging.basicConfig(
@@ -40,39 +116,190 @@ logger = logging.getLogger("check_analyzer")
 
 # ===== FASTAPI SETUP =====
 app = FastAPI(title="Turkish Check Analyzer API", version="3.0.0")
+
+
+class RequestSizeLimitMiddleware:
+    """Reject oversized uploads from Content-Length, before the multipart body is received.
+
+    Plain ASGI rather than ``@app.middleware("http")``, which would pipe every response,
+    SSE streams included, through an extra task. Chunked requests carry no Content-Length;
+    validate_upload_size still checks those once parsed.
+    """
+
+    def __init__(self, app, max_body_bytes: int):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if content_length.isdigit() and int(content_length) > self.max_body_bytes:
+                response = Response(
+                    content=orjson.dumps({
+                        "detail": f"Request body too large: {int(content_length)} bytes. Maximum image size: {MAX_UPLOAD_BYTES} bytes"
+                    }),
+                    status_code=413,
+                    media_type="application/json",
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+# Added before CORS so that CORS, added later and therefore outermost, also covers its 413s
+app.add_middleware(RequestSizeLimitMiddleware, max_body_bytes=MAX_UPLOAD_BYTES + MAX_REQUEST_OVERHEAD_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# OCR text and LLM analyses are repetitive JSON; SSE streams are excluded here and compressed in progress_stream
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# ===== OCR WORKER POOLS =====
+# Persistent worker processes per engine: the OCR wrappers are CPU-heavy Python code
+# that would otherwise serialize on the GIL inside the default thread pool.
+# Tesseract is single-threaded per worker (OMP_THREAD_LIMIT=1), so concurrent checks scale
+# across TESSERACT_WORKERS processes; the model-based engines keep one worker each.
+# "spawn" avoids forking a process that already runs threads (aiohttp, torch).
+_ocr_mp_context = multiprocessing.get_context("spawn")
+
+
+def create_ocr_pool(*engines: str, workers: int = 1) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=_ocr_mp_context, initializer=init_ocr_worker, initargs=engines
+    )
+
+
+def create_ocr_pools(gpu: bool) -> Dict[str, ProcessPoolExecutor]:
+    """Build the worker pools per engine; no processes start until the first submit."""
+    tesseract_pool = create_ocr_pool("tesseract", workers=TESSERACT_WORKERS)
+    if gpu:
+        # EasyOCR and PaddleOCR share a single GPU worker so only one process holds a CUDA context
+        gpu_pool = create_ocr_pool("easyocr", "paddleocr")
+        return {"tesseract": tesseract_pool, "easyocr": gpu_pool, "paddleocr": gpu_pool}
+    return {
+        "tesseract": tesseract_pool,
+        "easyocr": create_ocr_pool("easyocr"),
+        "paddleocr": create_ocr_pool("paddleocr"),
+    }
+
+
+async def detect_ocr_gpu() -> bool:
+    """Probe for CUDA in a throwaway worker; the probe imports torch, which the API process never needs."""
+    loop = asyncio.get_running_loop()
+    probe = ProcessPoolExecutor(max_workers=1, mp_context=_ocr_mp_context)
+    try:
+        return await loop.run_in_executor(probe, cuda_available)
+    except Exception as e:
+        logger.warning(f"⚠️ CUDA probe failed, running EasyOCR/PaddleOCR on CPU: {e}")
+        return False
+    finally:
+        probe.shutdown(wait=False)
+
+
+# Filled at startup, so importing this module (as spawned workers do) doesn't create pools
+OCR_POOLS: Dict[str, ProcessPoolExecutor] = {}
+
+
+def replace_broken_ocr_pool(pool: ProcessPoolExecutor) -> None:
+    """Swap a pool whose worker died (OOM kill, native crash) for a fresh one.
+
+    A ProcessPoolExecutor stays broken once any of its workers dies. Every engine mapped to
+    the pool gets the replacement, so the shared GPU pool is rebuilt once for both engines.
+    """
+    engines = [engine for engine, engine_pool in OCR_POOLS.items() if engine_pool is pool]
+    if not engines:
+        # Another request already replaced it
+        return
+    workers = TESSERACT_WORKERS if "tesseract" in engines else 1
+    replacement = create_ocr_pool(*engines, workers=workers)
+    for engine in engines:
+        OCR_POOLS[engine] = replacement
+    pool.shutdown(wait=False, cancel_futures=True)
+    logger.warning(f"⚠️ OCR worker pool for {', '.join(engines)} was broken and has been restarted")
+
+
+async def run_in_ocr_pool(engine: str, func, *args):
+    """Run ``func`` in the engine's worker pool, restarting the pool and retrying once if it broke."""
+    loop = asyncio.get_running_loop()
+    pool = OCR_POOLS[engine]
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        replace_broken_ocr_pool(pool)
+        return await loop.run_in_executor(OCR_POOLS[engine], func, *args)
+
+
+async def run_easyocr_batch(image_refs: List[Tuple[str, Tuple[int, ...], str]]) -> List[Optional[str]]:
+    return await run_in_ocr_pool("easyocr", easyocr_shared_images_batched, image_refs)
+
+
+easyocr_batcher: Optional[MicroBatcher] = None
+if EASYOCR_BATCH_SIZE > 1:
+    easyocr_batcher = MicroBatcher(run_easyocr_batch, EASYOCR_BATCH_SIZE, EASYOCR_BATCH_WAIT_MS / 1000)
+
+# OCR results keyed by image content hash, so re-uploads of the same check skip OCR
+OCR_CACHE = TTLCache(maxsize=OCR_CACHE_SIZE, ttl=OCR_CACHE_TTL)
 
 # ===== PROGRESS TRACKING =====
-# In-memory storage for progress tracking (use Redis in production)
-progress_storage: Dict[str, Dict] = {}
+TOTAL_PHASES = 6
+# Progress percentage per phase, precomputed as int((phase / TOTAL_PHASES) * 100)
+_PHASE_PCT = (0, 16, 33, 50, 66, 83, 100)
+
+# In-memory storage for progress tracking (use Redis in production), bounded in size and age
+progress_storage = TTLCache(maxsize=PROGRESS_MAX_SESSIONS, ttl=PROGRESS_SESSION_TTL)
+# Live SSE subscriber queues per session, kept apart so progress_storage stays JSON-serializable
+progress_subscribers: Dict[str, List[asyncio.Queue]] = {}
+SSE_KEEPALIVE_SECONDS = 30
+
+# Set at startup when REDIS_URL is configured
+redis_client = None
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks = set()
+
+
+def redis_state_key(session_id: str) -> str:
+    return f"progress:{session_id}:state"
+
+
+def redis_logs_key(session_id: str) -> str:
+    return f"progress:{session_id}:logs"
 
 class ProgressTracker:
     """Track and broadcast progress updates."""
     
     def __init__(self, session_id: str):
         self.session_id = session_id
+        # Wall clock for clients, monotonic clock for durations
         self.start_time = time.time()
-        progress_storage[session_id] = {
+        self._start_ns = time.monotonic_ns()
+        self._state = progress_storage[session_id] = {
             "status": "initialized",
             "phase": 0,
-            "total_phases": 6,
+            "total_phases": TOTAL_PHASES,
             "message": "Starting process...",
             "progress": 0,
             "start_time": self.start_time,
-            "logs": [],
+            "logs": deque(maxlen=PROGRESS_MAX_LOGS),
             "result": None,
             "error": None
         }
+        
+        # Redis writes go through one queue per tracker so log order is preserved
+        self._redis_writes: Optional[asyncio.Queue] = None
+        if redis_client is not None:
+            self._redis_writes = asyncio.Queue()
+            task = asyncio.create_task(self._redis_writer())
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+            self._publish_remote()
     
     def update(self, phase: int, status: str, message: str, details: Optional[Dict] = None):
         """Update progress and log."""
-        elapsed = time.time() - self.start_time
-        progress_percent = int((phase / 6) * 100)
+        elapsed = self.elapsed()
+        progress_percent = _PHASE_PCT[phase]
         
         log_entry = {
             "timestamp": time.time(),
@@ -83,70 +310,141 @@ class ProgressTracker:
             "details": details or {}
         }
         
-        if self.session_id in progress_storage:
-            progress_storage[self.session_id].update({
-                "status": status,
-                "phase": phase,
-                "message": message,
-                "progress": progress_percent,
-                "elapsed": round(elapsed, 2)
-            })
-            progress_storage[self.session_id]["logs"].append(log_entry)
+        self._state.update({
+            "status": status,
+            "phase": phase,
+            "message": message,
+            "progress": progress_percent,
+            "elapsed": round(elapsed, 2)
+        })
+        self._state["logs"].append(log_entry)
+        self._publish(log_entry)
+        self._publish_remote(log_entry)
         
         # Log to console as well
         emoji = {"success": "✅", "error": "❌", "processing": "🔄", "info": "ℹ️"}.get(status, "📝")
-        logger.info(f"{emoji} [{self.session_id[:8]}] Phase {phase}/6 ({progress_percent}%) - {message}")
+        logger.info(f"{emoji} [{self.session_id[:8]}] Phase {phase}/{TOTAL_PHASES} ({progress_percent}%) - {message}")
         
         if details:
             logger.debug(f"🔍 [{self.session_id[:8]}] Details: {details}")
     
+    def elapsed(self) -> float:
+        """Seconds since the tracker was created."""
+        return (time.monotonic_ns() - self._start_ns) / 1e9
+    
     def set_result(self, result: Dict):
         """Set final result."""
-        if self.session_id in progress_storage:
-            progress_storage[self.session_id]["result"] = result
-            progress_storage[self.session_id]["status"] = "completed"
-            progress_storage[self.session_id]["progress"] = 100
+        self._state["result"] = result
+        self._state["status"] = "completed"
+        self._state["progress"] = 100
+        self._state["end_time"] = time.time()
+        final_event = {"status": "completed", "final": True}
+        self._publish(final_event)
+        self._publish_remote(final_event)
     
     def set_error(self, error: str):
         """Set error state."""
-        if self.session_id in progress_storage:
-            progress_storage[self.session_id]["error"] = error
-            progress_storage[self.session_id]["status"] = "error"
+        self._state["error"] = error
+        self._state["status"] = "error"
+        self._state["end_time"] = time.time()
+        final_event = {"status": "error", "final": True}
+        self._publish(final_event)
+        self._publish_remote(final_event)
+
+    def is_finished(self) -> bool:
+        """Whether set_result or set_error has ended the session."""
+        return "end_time" in self._state
+
+    def stream_token(self, model: str, token: str):
+        """Forward a generated token to live SSE streams; tokens are not kept in the log."""
+        self._publish({"type": "token", "model": model, "token": token})
+
+    def _publish(self, event: Dict):
+        """Push an event to every SSE stream listening on this session."""
+        for queue in progress_subscribers.get(self.session_id, ()):
+            queue.put_nowait(event)
+
+    def _publish_remote(self, event: Optional[Dict] = None):
+        """Queue the current state, and optionally a log event, for the Redis writer."""
+        if self._redis_writes is None:
+            return
+        state = {k: v for k, v in self._state.items() if k != "logs"}
+        self._redis_writes.put_nowait((dumps_json(state), dumps_json(event) if event else None))
+        if event and event.get("final"):
+            self._redis_writes.put_nowait(None)
+
+    async def _redis_writer(self):
+        """Mirror state into ``progress:{id}:state`` and append logs to the ``progress:{id}:logs`` stream."""
+        state_key = redis_state_key(self.session_id)
+        logs_key = redis_logs_key(self.session_id)
+        while True:
+            item = await self._redis_writes.get()
+            if item is None:
+                break
+            state, event = item
+            try:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    pipe.set(state_key, state, ex=PROGRESS_SESSION_TTL)
+                    if event is not None:
+                        pipe.xadd(logs_key, {"data": event}, maxlen=PROGRESS_MAX_LOGS, approximate=True)
+                        pipe.expire(logs_key, PROGRESS_SESSION_TTL)
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning(f"⚠️ [{self.session_id[:8]}] Failed to write progress to Redis: {e}")
+
+
+async def purge_progress_sessions(interval: float = 60.0):
+    """Periodically drop expired sessions and finished sessions older than PROGRESS_FINISHED_TTL."""
+    while True:
+        await asyncio.sleep(interval)
+        removed = progress_storage.expire()
+        cutoff = time.time() - PROGRESS_FINISHED_TTL
+        for session_id, session_data in progress_storage.items():
+            end_time = session_data.get("end_time")
+            if end_time is not None and end_time < cutoff:
+                progress_storage.pop(session_id)
+                removed += 1
+        if removed:
+            logger.debug(f"🧹 Purged {removed} progress sessions, {len(progress_storage)} remaining")
 
 
 # ===== HELPER FUNCTIONS =====
 
+# Vision models - sadece görsel analiz yapar, JSON döndürmez
+VISION_MODELS = ['llava', 'bakllava', 'moondream', 'llava-phi3', 'llava-llama3']
+
+# Code models - kod yapar, çek analizi yapmaz  
+CODE_MODELS = ['codellama', 'codegemma', 'starcoder', 'codeqwen', 'phind-codellama']
+
+# Embedding models - sadece embedding üretir
+EMBEDDING_MODELS = ['nomic-embed', 'all-minilm', 'mxbai-embed', 'snowflake-arctic-embed']
+
+# Math/reasoning specific models that might not follow JSON format
+SPECIALIZED_MODELS = ['mathstral', 'nous-hermes2-mixtral', 'wizard-math']
+
+# Very small models might not be good for complex analysis
+SMALL_MODEL_SIZES = ['1b', '0.5b', '512m', '256m']
+
+# All unsupported substrings compiled into one alternation, so each model name is scanned once
+_UNSUPPORTED_MODEL_RE = re.compile(
+    "(?P<category>{})|(?P<size>{})".format(
+        "|".join(map(re.escape, VISION_MODELS + CODE_MODELS + EMBEDDING_MODELS + SPECIALIZED_MODELS)),
+        "|".join(map(re.escape, SMALL_MODEL_SIZES)),
+    )
+)
+
+
 def validate_model_for_check_analysis(model_name: str) -> bool:
     """Validate if model is suitable for check analysis."""
+    match = _UNSUPPORTED_MODEL_RE.search(model_name.lower())
+    if match is None:
+        return True
     
-    # Vision models - sadece görsel analiz yapar, JSON döndürmez
-    vision_models = ['llava', 'bakllava', 'moondream', 'llava-phi3', 'llava-llama3']
-    
-    # Code models - kod yapar, çek analizi yapmaz  
-    code_models = ['codellama', 'codegemma', 'starcoder', 'codeqwen', 'phind-codellama']
-    
-    # Embedding models - sadece embedding üretir
-    embedding_models = ['nomic-embed', 'all-minilm', 'mxbai-embed', 'snowflake-arctic-embed']
-    
-    # Math/reasoning specific models that might not follow JSON format
-    specialized_models = ['mathstral', 'nous-hermes2-mixtral', 'wizard-math']
-    
-    model_lower = model_name.lower()
-    
-    # Check against all unsupported categories
-    unsupported_categories = vision_models + code_models + embedding_models + specialized_models
-    
-    for unsupported in unsupported_categories:
-        if unsupported in model_lower:
-            logger.info(f"🚫 Model {model_name} filtered out: contains '{unsupported}' (unsupported category)")
-            return False
-    
-    # Additional checks for model size (very small models might not be good for complex analysis)
-    if any(x in model_lower for x in ['1b', '0.5b', '512m', '256m']):
+    if match.group("category"):
+        logger.info(f"🚫 Model {model_name} filtered out: contains '{match.group(0)}' (unsupported category)")
+    else:
         logger.info(f"🚫 Model {model_name} filtered out: too small for complex analysis")
-        return False
-    
-    return True
+    return False
 
 def filter_supported_models(models: List[Dict]) -> List[Dict]:
     """Filter models that are suitable for check analysis."""
@@ -164,6 +462,88 @@ def filter_supported_models(models: List[Dict]) -> List[Dict]:
     logger.info(f"📊 Model filtering: {len(supported_models)} approved, {filtered_count} filtered out")
     return supported_models
 
+def dumps_json(data: object) -> bytes:
+    """Serialize with orjson; deques (progress logs) are written as lists.
+
+    Model output can hold integers wider than 64 bits, which orjson rejects, so those
+    payloads fall back to the standard library encoder.
+    """
+    try:
+        return orjson.dumps(data, default=list)
+    except TypeError:
+        return json.dumps(data, default=list, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads_json(data: bytes) -> object:
+    """Parse JSON written by :func:`dumps_json`.
+
+    Uses the standard library parser, since orjson would silently turn integers wider than
+    64 bits into floats.
+    """
+    return json.loads(data)
+
+
+def orjson_response(data: Dict) -> Response:
+    """JSON response serialized by :func:`dumps_json`."""
+    return Response(content=dumps_json(data), media_type="application/json")
+
+
+def sse_event(data: Dict) -> bytes:
+    """Encode a payload as a Server-Sent Events data frame."""
+    return b"data: " + dumps_json(data) + b"\n\n"
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip, honouring q-values (``gzip;q=0`` refuses it)."""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+async def gzip_stream(chunks: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """Gzip a byte stream, flushing after every chunk so each SSE event reaches the client immediately."""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    async for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def extract_json_object(text: str) -> Tuple[object, bool]:
+    """Parse model output as JSON, tolerating chatter around the first JSON object.
+
+    Returns the parsed value and whether it had to be extracted from surrounding text.
+    Raises ``json.JSONDecodeError`` when no JSON object can be decoded.
+    """
+    try:
+        # Ollama's JSON mode normally returns a bare object. The standard library parser keeps
+        # integers wider than 64 bits exact, where orjson would silently turn them into floats.
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        start_idx = text.find('{')
+        if start_idx == -1:
+            raise
+    
+    # Sometimes models add extra text before/after JSON: decode in place from the first brace
+    analysis, _ = _JSON_DECODER.raw_decode(text, start_idx)
+    return analysis, True
+
+
 def load_prompt() -> str:
     """Load and return the prompt template."""
     if not PROMPT_PATH.exists():
@@ -176,65 +556,189 @@ def load_prompt() -> str:
         raise HTTPException(status_code=500, detail=f"Failed to read prompt: {e}")
 
 
-async def run_ocr_parallel(processed_image, tracker: ProgressTracker) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Run OCR engines in parallel with progress tracking."""
-    tracker.update(2, "processing", "Starting OCR engines in parallel...")
+def prompt_version() -> Optional[int]:
+    """Cache key for the prompt template: its mtime with PROMPT_RELOAD, otherwise fixed."""
+    if not PROMPT_RELOAD:
+        return None
+    try:
+        return PROMPT_PATH.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def load_prompt_template(version: Optional[int] = None) -> Tuple[str, ...]:
+    """Load the prompt template once per ``version``, pre-split around its placeholders.
+
+    Even positions hold literal text, odd positions placeholder names, so rendering is a
+    single join instead of a scan of the template per placeholder.
+    """
+    segments = tuple(PROMPT_PLACEHOLDER_PATTERN.split(load_prompt()))
+    names = set(segments[1::2])
+    if "ocr_text" not in names:
+        raise HTTPException(status_code=500, detail="Prompt template has no ${ocr_text} placeholder.")
+    unknown = names.difference(PROMPT_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=500, detail=f"Prompt template has unknown placeholders: {', '.join(sorted(unknown))}")
+    return segments
+
+
+def build_prompt(ocr_text: str) -> str:
+    """Fill the cached prompt template with the OCR text."""
+    segments = load_prompt_template(prompt_version())
+    values = {"ocr_text": ocr_text}
+    return "".join(values[segment] if index % 2 else segment for index, segment in enumerate(segments))
+
+
+def is_ocr_text_sufficient(text: Optional[str]) -> bool:
+    """Check whether a single OCR result is rich enough to skip the other engines."""
+    if not text:
+        return False
+    stripped = text.strip()
+    if len(stripped) < OCR_MIN_CHARS:
+        return False
+    # Checks always carry numbers (IBAN, amount, check number, date)
+    digit_count = sum(1 for ch in stripped if ch.isdigit())
+    return digit_count >= OCR_MIN_DIGITS
+
+
+async def run_ocr_parallel(processed_image: np.ndarray, tracker: ProgressTracker) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Run OCR engines in parallel with progress tracking.
+
+    The preprocessed image is copied once into shared memory that all engine workers read from.
+    With ``OCR_STRATEGY=fast`` Tesseract runs first and EasyOCR and PaddleOCR are only
+    submitted when its output is not sufficient, so their workers stay free otherwise.
+    """
+    tracker.update(2, "processing", f"Starting OCR engines in parallel (strategy: {OCR_STRATEGY})...")
     
-    async def run_tesseract():
-        try:
-            tracker.update(2, "processing", "Running Tesseract OCR...")
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, extract_text_tesseract, processed_image)
-            tracker.update(2, "info", f"Tesseract completed: {len(result) if result else 0} characters")
-            return result
-        except Exception as e:
-            tracker.update(2, "error", f"Tesseract failed: {str(e)}")
-            return None
+    shm = shared_memory.SharedMemory(create=True, size=max(processed_image.nbytes, 1))
+    np.copyto(np.ndarray(processed_image.shape, dtype=processed_image.dtype, buffer=shm.buf), processed_image)
+    image_ref = (shm.name, processed_image.shape, processed_image.dtype.str)
     
-    async def run_easyocr():
+    async def run_engine(engine: str, label: str, extract_func):
         try:
-            tracker.update(2, "processing", "Running EasyOCR...")
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, extract_text_easyocr, processed_image)
-            tracker.update(2, "info", f"EasyOCR completed: {len(result) if result else 0} characters")
+            tracker.update(2, "processing", f"Running {label}...")
+            if engine == "easyocr" and easyocr_batcher is not None:
+                result = await easyocr_batcher.submit(image_ref)
+            else:
+                result = await run_in_ocr_pool(engine, ocr_shared_image, extract_func, *image_ref)
+            tracker.update(2, "info", f"{label} completed: {len(result) if result else 0} characters")
             return result
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            tracker.update(2, "error", f"EasyOCR failed: {str(e)}")
+            tracker.update(2, "error", f"{label} failed: {str(e)}")
             return None
 
-    async def run_paddleocr():
-        try:
-            tracker.update(2, "processing", "Running PaddleOCR...")
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, extract_text_paddleocr, processed_image)
-            tracker.update(2, "info", f"PaddleOCR completed: {len(result) if result else 0} characters")
-            return result
-        except Exception as e:
-            tracker.update(2, "error", f"PaddleOCR failed: {str(e)}")
-            return None
-    ocr_results = await asyncio.gather(
-        run_tesseract(),
-        run_easyocr(),
-        run_paddleocr(),
-        return_exceptions=True,
-    )
+    try:
+        tesseract_task = asyncio.create_task(run_engine("tesseract", "Tesseract OCR", extract_text_tesseract))
 
-    tesseract_result = ocr_results[0] if not isinstance(ocr_results[0], Exception) else None
-    easyocr_result = ocr_results[1] if not isinstance(ocr_results[1], Exception) else None
-    paddleocr_result = ocr_results[2] if not isinstance(ocr_results[2], Exception) else None
+        skipped = False
+        if OCR_STRATEGY == "fast":
+            # An executor job can't be cancelled once running, so the slower engines are only
+            # submitted when they are actually needed
+            skipped = is_ocr_text_sufficient(await tesseract_task)
+
+        if skipped:
+            tracker.update(2, "info", "Tesseract output sufficient, skipped EasyOCR and PaddleOCR")
+            ocr_results = [tesseract_task.result(), None, None]
+        else:
+            ocr_results = await asyncio.gather(
+                tesseract_task,
+                run_engine("easyocr", "EasyOCR", extract_text_easyocr),
+                run_engine("paddleocr", "PaddleOCR", extract_text_paddleocr),
+                return_exceptions=True,
+            )
+    finally:
+        # Workers still running an engine for a cancelled request keep their own mapping until they finish
+        shm.close()
+        shm.unlink()
+
+    tesseract_result = ocr_results[0] if not isinstance(ocr_results[0], BaseException) else None
+    easyocr_result = ocr_results[1] if not isinstance(ocr_results[1], BaseException) else None
+    paddleocr_result = ocr_results[2] if not isinstance(ocr_results[2], BaseException) else None
 
     tracker.update(3, "success", "OCR processing completed", {
         "tesseract_chars": len(tesseract_result) if tesseract_result else 0,
         "easyocr_chars": len(easyocr_result) if easyocr_result else 0,
         "paddleocr_chars": len(paddleocr_result) if paddleocr_result else 0,
+        "secondary_engines_skipped": skipped,
     })
 
     return tesseract_result, easyocr_result, paddleocr_result
 
 
+def hash_image_stream(fp: BinaryIO) -> str:
+    """Hash an image stream in chunks and rewind it for the next reader."""
+    digest = hashlib.blake2b(digest_size=16)
+    fp.seek(0)
+    for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    fp.seek(0)
+    return digest.hexdigest()
+
+
+async def run_ocr_pipeline(image_stream: BinaryIO, tracker: ProgressTracker) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Preprocess and OCR an image, reusing cached results for identical uploads."""
+    # Reading and hashing up to MAX_UPLOAD_BYTES would otherwise stall the event loop
+    cache_key = await asyncio.to_thread(hash_image_stream, image_stream)
+    cached = OCR_CACHE.get(cache_key)
+    if cached is not None:
+        tracker.update(3, "success", "OCR results loaded from cache", {"image_hash": cache_key})
+        return cached
+
+    tracker.update(1, "processing", "Starting image preprocessing...")
+    # Decoding, denoising and deskewing are CPU-bound; OpenCV releases the GIL, so keep the event loop free
+    processed_image = await asyncio.to_thread(preprocess_image_stream, image_stream, high_quality=OCR_HIGH_QUALITY_DENOISE)
+    tracker.update(1, "success", "Image preprocessing completed")
+
+    ocr_results = await run_ocr_parallel(processed_image, tracker)
+    # Don't pin failures in the cache, they may be transient
+    if any(ocr_results):
+        OCR_CACHE.set(cache_key, ocr_results)
+    return ocr_results
+
+
+async def read_ollama_stream(response: aiohttp.ClientResponse, on_token: Optional[Callable[[str], None]] = None) -> str:
+    """Accumulate a streamed /api/generate response, passing each token to ``on_token``.
+
+    Returns early, closing the connection so Ollama stops generating, as soon as the
+    accumulated text contains a complete JSON object.
+    """
+    parts: List[str] = []
+    async for line in response.content:
+        if not line.strip():
+            continue
+        chunk = orjson.loads(line)
+        if chunk.get("error"):
+            raise RuntimeError(chunk["error"])
+        
+        piece = chunk.get("response", "")
+        parts.append(piece)
+        if piece and on_token is not None:
+            on_token(piece)
+        if chunk.get("done"):
+            break
+        
+        # Only a closing brace can complete the object, so don't re-parse on every token
+        if "}" in piece:
+            text = "".join(parts)
+            start_idx = text.find('{')
+            if start_idx == -1:
+                continue
+            try:
+                _JSON_DECODER.raw_decode(text, start_idx)
+            except json.JSONDecodeError:
+                continue
+            response.close()
+            return text
+    
+    return "".join(parts)
+
+
 async def call_ollama_model(session: aiohttp.ClientSession, base_url: str, model: str, prompt: str, tracker: ProgressTracker) -> Dict:
     """Make async call to Ollama model with enhanced error handling."""
-    start_time = time.time()
+    start_ns = time.monotonic_ns()
     tracker.update(5, "processing", f"Calling model: {model}")
     
     # Model uygunluk kontrolü (ekstra güvenlik)
@@ -246,84 +750,177 @@ async def call_ollama_model(session: aiohttp.ClientSession, base_url: str, model
     payload = {
         "model": model,
         "prompt": prompt,
-        "stream": False,
-        "format": "json"  # Ollama'ya JSON format istediğimizi söyle
+        "stream": True,  # NDJSON chunks, lets us stop as soon as the JSON object is complete
+        "format": "json",  # Ollama'ya JSON format istediğimizi söyle
+        "keep_alive": OLLAMA_KEEP_ALIVE
     }
+    if OLLAMA_NUM_CTX:
+        payload["options"] = {"num_ctx": OLLAMA_NUM_CTX}
+    
+    # Encode once: orjson writes the prompt straight to UTF-8 bytes, which go out as the body as-is
+    body = orjson.dumps(payload)
     
     try:
         tracker.update(5, "processing", f"Sending request to {model}...", {
-            "payload_size": len(json.dumps(payload))
+            "payload_size": len(body)
         })
         
-        async with session.post(
-            f"{base_url}/api/generate",
-            json=payload,
-            timeout=aiohttp.ClientTimeout(total=180)
-        ) as response:
-            
-            tracker.update(5, "info", f"Model {model} responded with status: {response.status}")
-            
-            if response.status != 200:
-                error_text = await response.text()
-                tracker.update(5, "error", f"Model {model} failed", {"status": response.status, "error": error_text})
-                return {"model_name": model, "analysis": None, "error": f"HTTP {response.status}: {error_text}"}
-            
-            response_data = await response.json()
-            response_text = response_data.get("response", "")
+        status, response_text = await request_ollama_generate(session, base_url, model, body, tracker)
+        if status != 200:
+            tracker.update(5, "error", f"Model {model} failed", {"status": status, "error": response_text})
+            return {"model_name": model, "analysis": None, "error": f"HTTP {status}: {response_text}"}
+        
+        elapsed = (time.monotonic_ns() - start_ns) / 1e9
+        tracker.update(5, "success", f"Model {model} completed", {
+            "response_length": len(response_text),
+            "elapsed": round(elapsed, 2)
+        })
+        
+        try:
+            analysis, extracted = extract_json_object(response_text)
+            if extracted:
+                tracker.update(5, "info", f"Extracted JSON from model {model} response")
+            tracker.update(5, "success", f"Model {model} returned valid JSON analysis")
+            return {"model_name": model, "analysis": analysis, "error": None}
             
-            elapsed = time.time() - start_time
-            tracker.update(5, "success", f"Model {model} completed", {
-                "response_length": len(response_text),
-                "elapsed": round(elapsed, 2)
+        except json.JSONDecodeError as e:
+            # Daha detaylı JSON hata analizi
+            tracker.update(5, "error", f"Model {model} returned invalid JSON", {
+                "error": str(e),
+                "response_preview": response_text[:200] if response_text else "Empty response"
             })
             
-            try:
-                # JSON parsing with better error handling
-                response_text = response_text.strip()
-                
-                # Sometimes models add extra text before/after JSON
-                if not response_text.startswith('{') and '{' in response_text:
-                    start_idx = response_text.find('{')
-                    end_idx = response_text.rfind('}') + 1
-                    if start_idx != -1 and end_idx != -1:
-                        response_text = response_text[start_idx:end_idx]
-                        tracker.update(5, "info", f"Extracted JSON from model {model} response")
-                
-                analysis = json.loads(response_text)
-                tracker.update(5, "success", f"Model {model} returned valid JSON analysis")
-                return {"model_name": model, "analysis": analysis, "error": None}
-                
-            except json.JSONDecodeError as e:
-                # Daha detaylı JSON hata analizi
-                tracker.update(5, "error", f"Model {model} returned invalid JSON", {
-                    "error": str(e),
-                    "response_preview": response_text[:200] if response_text else "Empty response"
-                })
-                
-                # Eğer response açık text ise, kullanıcıya öner
-                if len(response_text) > 50 and not response_text.strip().startswith('{'):
-                    suggestion = f"Model returned plain text instead of JSON. This model may not support structured output."
-                    return {"model_name": model, "analysis": None, "error": f"Invalid JSON: {suggestion}"}
-                else:
-                    return {"model_name": model, "analysis": None, "error": f"JSON parsing failed: {str(e)}"}
-                
+            # Eğer response açık text ise, kullanıcıya öner
+            if len(response_text) > 50 and not response_text.lstrip().startswith('{'):
+                suggestion = f"Model returned plain text instead of JSON. This model may not support structured output."
+                return {"model_name": model, "analysis": None, "error": f"Invalid JSON: {suggestion}"}
+            else:
+                return {"model_name": model, "analysis": None, "error": f"JSON parsing failed: {str(e)}"}
+            
     except asyncio.TimeoutError:
-        elapsed = time.time() - start_time
+        elapsed = (time.monotonic_ns() - start_ns) / 1e9
         tracker.update(5, "error", f"Model {model} timed out after {elapsed:.2f}s")
         return {"model_name": model, "analysis": None, "error": "Request timeout"}
     except Exception as e:
-        elapsed = time.time() - start_time
+        elapsed = (time.monotonic_ns() - start_ns) / 1e9
         tracker.update(5, "error", f"Model {model} failed after {elapsed:.2f}s", {"error": str(e)})
         return {"model_name": model, "analysis": None, "error": str(e)}
 
 
-async def process_models_parallel(base_url: str, models: List[str], prompt: str, tracker: ProgressTracker) -> List[Dict]:
+# Shared across requests so the limit reflects the load on each Ollama host
+_ollama_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def get_ollama_semaphore(base_url: str) -> asyncio.Semaphore:
+    """Return the concurrency limiter for an Ollama host."""
+    semaphore = _ollama_semaphores.get(base_url)
+    if semaphore is None:
+        semaphore = _ollama_semaphores[base_url] = asyncio.Semaphore(OLLAMA_CONCURRENCY)
+    return semaphore
+
+
+_ollama_rate_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_ollama_rate_limiter(base_url: str) -> RateLimiter:
+    """Return the request pacing limiter for an Ollama host."""
+    limiter = _ollama_rate_limiters.get(base_url)
+    if limiter is None:
+        limiter = _ollama_rate_limiters[base_url] = RateLimiter(OLLAMA_MIN_INTERVAL)
+    return limiter
+
+
+def is_retryable_ollama_response(status: int, error_text: str) -> bool:
+    """Whether a failed generate call is worth retrying (overloaded or rate-limited server)."""
+    return status in OLLAMA_RETRY_STATUSES or "rate limit" in error_text.lower()
+
+
+async def request_ollama_generate(session: aiohttp.ClientSession, base_url: str, model: str, body: bytes, tracker: ProgressTracker) -> Tuple[int, str]:
+    """POST to /api/generate under the host's concurrency limit, retrying transient failures.
+
+    Returns the HTTP status with the streamed response text, or with the error body for
+    non-200 responses.
+    """
+    semaphore = get_ollama_semaphore(base_url)
+    rate_limiter = get_ollama_rate_limiter(base_url)
+    streamed = False
+
+    def on_token(token: str):
+        nonlocal streamed
+        streamed = True
+        tracker.stream_token(model, token)
+
+    for attempt in range(1, OLLAMA_MAX_ATTEMPTS + 1):
+        try:
+            async with semaphore:
+                await rate_limiter.wait()
+                async with session.post(
+                    f"{base_url}/api/generate",
+                    data=body,
+                    headers={"Content-Type": "application/json"},
+                    timeout=aiohttp.ClientTimeout(total=180, connect=10, sock_read=OLLAMA_CHUNK_TIMEOUT)
+                ) as response:
+                    tracker.update(5, "info", f"Model {model} responded with status: {response.status}")
+                    if response.status == 200:
+                        return response.status, await read_ollama_stream(response, on_token=on_token)
+                    error_text = await response.text()
+            
+            if attempt == OLLAMA_MAX_ATTEMPTS or not is_retryable_ollama_response(response.status, error_text):
+                return response.status, error_text
+            reason = f"HTTP {response.status}"
+        except asyncio.TimeoutError:
+            # A stalled model (sock_read timeout, a ClientConnectionError subclass too) would
+            # likely stall again while holding the host's slot
+            raise
+        except aiohttp.ClientConnectionError as e:
+            # Once tokens went out to the progress stream a retry would send them twice
+            if attempt == OLLAMA_MAX_ATTEMPTS or streamed:
+                raise
+            reason = str(e) or type(e).__name__
+        
+        # Back off outside the semaphore so other calls can use the slot meanwhile
+        delay = min(OLLAMA_RETRY_BASE_DELAY * 2 ** (attempt - 1), OLLAMA_RETRY_MAX_DELAY)
+        tracker.update(5, "info", f"Model {model} unavailable ({reason}), retrying in {delay:g}s", {
+            "attempt": attempt,
+            "max_attempts": OLLAMA_MAX_ATTEMPTS
+        })
+        await asyncio.sleep(delay)
+
+
+async def prewarm_ollama_models(session: aiohttp.ClientSession, base_url: str, models: List[str]):
+    """Load models into Ollama ahead of the first check; a generate call without a prompt only loads the model."""
+    for model in models:
+        payload = {"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}
+        if OLLAMA_NUM_CTX:
+            payload["options"] = {"num_ctx": OLLAMA_NUM_CTX}
+        try:
+            async with session.post(
+                f"{base_url}/api/generate",
+                data=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=aiohttp.ClientTimeout(total=300, connect=10)
+            ) as response:
+                await response.read()
+                if response.status == 200:
+                    logger.info(f"🔥 Model {model} loaded (keep_alive={OLLAMA_KEEP_ALIVE})")
+                else:
+                    logger.warning(f"⚠️ Could not prewarm model {model}: HTTP {response.status}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not prewarm model {model}: {e}")
+
+
+async def process_models_parallel(session: aiohttp.ClientSession, base_url: str, models: List[str], prompt: str, tracker: ProgressTracker) -> List[Dict]:
     """Process multiple models in parallel with progress tracking."""
     tracker.update(5, "processing", f"Starting parallel processing of {len(models)} models")
     
-    async with aiohttp.ClientSession() as session:
-        tasks = [call_ollama_model(session, base_url, model, prompt, tracker) for model in models]
-        results = await asyncio.gather(*tasks)
+    # Concurrency per host is limited inside request_ollama_generate, so retry backoffs don't hold a slot
+    tasks = [call_ollama_model(session, base_url, model, prompt, tracker) for model in models]
+    # One model failing unexpectedly must not discard the analyses of the others
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    results = [
+        {"model_name": model, "analysis": None, "error": str(outcome)} if isinstance(outcome, Exception) else outcome
+        for model, outcome in zip(models, outcomes)
+    ]
     
     successful_models = sum(1 for r in results if r["error"] is None)
     tracker.update(5, "success", f"All models processed", {
@@ -350,12 +947,56 @@ def validate_image_file(image_file: UploadFile, tracker: ProgressTracker) -> Non
     tracker.update(1, "success", f"Image file validated: {image_file.content_type}")
 
 
+def get_upload_size(image_file: UploadFile) -> int:
+    """Return the upload size in bytes without reading the file into memory."""
+    if image_file.size is not None:
+        return image_file.size
+    image_file.file.seek(0, os.SEEK_END)
+    size = image_file.file.tell()
+    image_file.file.seek(0)
+    return size
+
+
+def validate_upload_size(image_file: UploadFile) -> int:
+    """Reject uploads larger than MAX_UPLOAD_BYTES."""
+    size = get_upload_size(image_file)
+    if size > MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image file too large: {size} bytes. Maximum: {MAX_UPLOAD_BYTES} bytes"
+        )
+    return size
+
+
+def validate_image_dimensions(image_stream: BinaryIO) -> Tuple[int, int]:
+    """Reject images with too many pixels, reading only the image header."""
+    try:
+        width, height = read_image_size(image_stream)
+    except Image.DecompressionBombError:
+        # Pillow refuses to even open images far beyond its own pixel limit
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image too large. Maximum: {MAX_IMAGE_PIXELS // 1_000_000} megapixels"
+        )
+    except Exception as e:
+        # The exception text can carry the repr of the spooled upload file; keep it in the log
+        logger.warning(f"⚠️ Image header could not be read: {e}")
+        raise HTTPException(status_code=400, detail="Image could not be loaded")
+    
+    if width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image too large: {width}x{height} pixels. Maximum: {MAX_IMAGE_PIXELS // 1_000_000} megapixels"
+        )
+    return width, height
+
+
 def validate_models(selected_models_json: str, tracker: ProgressTracker) -> List[str]:
     """Validate and parse selected models JSON with progress tracking."""
     tracker.update(1, "processing", "Validating selected models")
     
     try:
-        selected_models = json.loads(selected_models_json)
+        selected_models = orjson.loads(selected_models_json)
         if not isinstance(selected_models, list) or not all(isinstance(m, str) for m in selected_models):
             raise ValueError("Models must be a list of strings")
         
@@ -397,13 +1038,8 @@ async def process_check_background(
     tracker = ProgressTracker(session_id)
     
     try:
-        # Phase 1: Image Processing
-        tracker.update(1, "processing", "Starting image preprocessing...")
-        processed_image = preprocess_image(image_bytes)
-        tracker.update(1, "success", f"Image preprocessing completed ({len(image_bytes)} bytes)")
-        
-        # Phase 2-3: OCR Processing
-        ocr_tesseract, ocr_easyocr, ocr_paddle = await run_ocr_parallel(processed_image, tracker)
+        # Phase 1-3: Image Processing and OCR
+        ocr_tesseract, ocr_easyocr, ocr_paddle = await run_ocr_pipeline(io.BytesIO(image_bytes), tracker)
         combined_text = combine_ocr_results(ocr_tesseract, ocr_easyocr, ocr_paddle, tracker)
         
         if not combined_text:
@@ -412,13 +1048,12 @@ async def process_check_background(
             return
         
         # Phase 4: Prompt Preparation
-        tracker.update(4, "processing", "Loading and preparing prompt template...")
-        prompt_template = load_prompt()
-        final_prompt = prompt_template.replace("${ocr_text}", combined_text)
+        tracker.update(4, "processing", "Preparing prompt from template...")
+        final_prompt = build_prompt(combined_text)
         tracker.update(4, "success", f"Prompt prepared ({len(final_prompt)} characters)")
         
         # Phase 5: LLM Analysis
-        analyses = await process_models_parallel(base_url, selected_models, final_prompt, tracker)
+        analyses = await process_models_parallel(app.state.http, base_url, selected_models, final_prompt, tracker)
         
         # Phase 6: Results
         successful_analyses = [a for a in analyses if a["error"] is None]
@@ -433,7 +1068,7 @@ async def process_check_background(
             "raw_ocr_easyocr": ocr_easyocr,
             "raw_ocr_paddleocr": ocr_paddle,
             "llm_analyses": analyses,
-            "processing_time": round(time.time() - tracker.start_time, 2),
+            "processing_time": round(tracker.elapsed(), 2),
             "success_rate": f"{len(successful_analyses)}/{len(selected_models)}"
         }
         
@@ -460,35 +1095,34 @@ async def list_ollama_models(ollama_url: str = Query(None)):
     logger.info(f"📋 Fetching Ollama models from: {base_url}")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{base_url}/api/tags", timeout=aiohttp.ClientTimeout(total=10)) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"❌ Ollama API error {response.status}: {error_text}")
-                    raise HTTPException(status_code=503, detail=f"Ollama API error: {error_text}")
-                
-                data = await response.json()
-                
-                # Handle different Ollama API response formats
-                if isinstance(data, dict) and "models" in data:
-                    all_models = data["models"]
-                else:
-                    all_models = data
-                
-                # Filter unsuitable models
-                supported_models = filter_supported_models(all_models)
-                
-                if not supported_models:
-                    logger.warning("⚠️ No suitable models found for check analysis")
-                    logger.info("💡 Recommended models: llama2:7b, mistral:7b, deepseek-r1:14b")
-                    raise HTTPException(
-                        status_code=404, 
-                        detail="No suitable models found. Please install text analysis models like: llama2:7b, mistral:7b, or deepseek-r1:14b"
-                    )
-                
-                logger.info(f"✅ Found {len(supported_models)} suitable models out of {len(all_models)} total")
-                return supported_models
-                
+        async with app.state.http.get(f"{base_url}/api/tags", timeout=aiohttp.ClientTimeout(total=10)) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                logger.error(f"❌ Ollama API error {response.status}: {error_text}")
+                raise HTTPException(status_code=503, detail=f"Ollama API error: {error_text}")
+            
+            data = orjson.loads(await response.read())
+            
+            # Handle different Ollama API response formats
+            if isinstance(data, dict) and "models" in data:
+                all_models = data["models"]
+            else:
+                all_models = data
+            
+            # Filter unsuitable models
+            supported_models = filter_supported_models(all_models)
+            
+            if not supported_models:
+                logger.warning("⚠️ No suitable models found for check analysis")
+                logger.info("💡 Recommended models: llama2:7b, mistral:7b, deepseek-r1:14b")
+                raise HTTPException(
+                    status_code=404, 
+                    detail="No suitable models found. Please install text analysis models like: llama2:7b, mistral:7b, or deepseek-r1:14b"
+                )
+            
+            logger.info(f"✅ Found {len(supported_models)} suitable models out of {len(all_models)} total")
+            return supported_models
+            
     except asyncio.TimeoutError:
         logger.error("⏰ Ollama service timeout")
         raise HTTPException(status_code=503, detail=f"Ollama service at {base_url} timeout")
@@ -513,13 +1147,17 @@ async def ocr_check_async(
         raise HTTPException(status_code=400, detail="Invalid image file type")
     
     try:
-        selected_models = json.loads(selected_models_json)
+        selected_models = orjson.loads(selected_models_json)
         if not isinstance(selected_models, list):
             raise ValueError("Models must be a list")
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid selected_models_json")
     
-    # Read image and start background processing
+    validate_upload_size(image_file)
+    
+    validate_image_dimensions(image_file.file)
+    
+    # The upload is closed once the response is sent, so the background task needs its own copy
     image_bytes = await image_file.read()
     base_url = ollama_url or OLLAMA_API_BASE_URL
     
@@ -537,50 +1175,106 @@ async def ocr_check_async(
 @app.get("/api/progress/{session_id}")
 async def get_progress(session_id: str):
     """Get current progress for a session."""
-    if session_id not in progress_storage:
-        raise HTTPException(status_code=404, detail="Session not found")
+    if session_id in progress_storage:
+        return orjson_response(progress_storage[session_id])
     
-    return progress_storage[session_id]
+    # The session may be running on another worker
+    if redis_client is not None:
+        state = await redis_client.get(redis_state_key(session_id))
+        if state is not None:
+            session_data = loads_json(state)
+            entries = await redis_client.xrange(redis_logs_key(session_id))
+            session_data["logs"] = [
+                log for log in (loads_json(fields[b"data"]) for _, fields in entries) if not log.get("final")
+            ]
+            return orjson_response(session_data)
+    
+    raise HTTPException(status_code=404, detail="Session not found")
 
 
 @app.get("/api/progress-stream/{session_id}")
-async def progress_stream(session_id: str):
-    """Server-Sent Events stream for real-time progress updates."""
+async def progress_stream(session_id: str, request: Request):
+    """Server-Sent Events stream for real-time progress updates.
+
+    Besides log entries, clients connected to the worker running the session receive
+    ``{"type": "token", "model": ..., "token": ...}`` events as the models generate.
+    """
     
-    async def event_generator() -> AsyncGenerator[str, None]:
-        """Generate SSE events."""
-        last_log_count = 0
-        
+    async def remote_event_generator() -> AsyncGenerator[bytes, None]:
+        """Generate SSE events from the Redis log stream of a session owned by another worker."""
+        logs_key = redis_logs_key(session_id)
+        last_id = "0-0"
         while True:
-            if session_id not in progress_storage:
-                yield f"data: {json.dumps({'error': 'Session not found'})}\n\n"
-                break
+            entries = await redis_client.xread({logs_key: last_id}, block=SSE_KEEPALIVE_SECONDS * 1000, count=100)
+            if not entries:
+                yield b": keep-alive\n\n"
+                continue
             
-            session_data = progress_storage[session_id]
-            
-            # Send new logs only
-            new_logs = session_data["logs"][last_log_count:]
-            if new_logs:
-                for log in new_logs:
-                    yield f"data: {json.dumps(log)}\n\n"
-                last_log_count = len(session_data["logs"])
+            for _, messages in entries:
+                for message_id, fields in messages:
+                    last_id = message_id
+                    event = loads_json(fields[b"data"])
+                    yield sse_event(event)
+                    if event.get("final"):
+                        return
+    
+    async def event_generator() -> AsyncGenerator[bytes, None]:
+        """Generate SSE events."""
+        if session_id not in progress_storage:
+            if redis_client is not None and await redis_client.exists(redis_state_key(session_id)):
+                async for chunk in remote_event_generator():
+                    yield chunk
+                return
+            yield sse_event({"error": "Session not found"})
+            return
+        
+        # Subscribe and snapshot the backlog in the same step so no log is lost or duplicated
+        queue: asyncio.Queue = asyncio.Queue()
+        subscribers = progress_subscribers.setdefault(session_id, [])
+        subscribers.append(queue)
+        session_data = progress_storage[session_id]
+        backlog = list(session_data["logs"])
+        finished_status = session_data["status"] if session_data["status"] in ["completed", "error"] else None
+        
+        try:
+            # Late subscribers first get everything logged so far
+            for log in backlog:
+                yield sse_event(log)
             
-            # Check if completed or errored
-            if session_data["status"] in ["completed", "error"]:
-                # Send final status
-                yield f"data: {json.dumps({'status': session_data['status'], 'final': True})}\n\n"
-                break
+            if finished_status:
+                yield sse_event({"status": finished_status, "final": True})
+                return
             
-            await asyncio.sleep(0.5)  # Poll every 500ms
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                
+                yield sse_event(event)
+                if event.get("final"):
+                    break
+        finally:
+            subscribers.remove(queue)
+            if not subscribers:
+                progress_subscribers.pop(session_id, None)
+    
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "Content-Type": "text/event-stream",
+        "Vary": "Accept-Encoding",
+    }
+    stream = event_generator()
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        headers["Content-Encoding"] = "gzip"
+        stream = gzip_stream(stream)
     
     return StreamingResponse(
-        event_generator(),
+        stream,
         media_type="text/plain",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream",
-        }
+        headers=headers
     )
 
 
@@ -601,27 +1295,24 @@ async def ocr_check_sync(
         base_url = ollama_url or OLLAMA_API_BASE_URL
         
         # Image Processing
-        image_bytes = await image_file.read()
-        tracker.update(1, "processing", f"Image loaded: {len(image_bytes)} bytes")
+        image_size = validate_upload_size(image_file)
+        width, height = validate_image_dimensions(image_file.file)
+        tracker.update(1, "processing", f"Image received: {image_size} bytes, {width}x{height} pixels")
         
-        processed_image = preprocess_image(image_bytes)
-        tracker.update(1, "success", "Image preprocessing completed")
-        
-        # OCR Processing
-        ocr_tesseract, ocr_easyocr, ocr_paddle = await run_ocr_parallel(processed_image, tracker)
+        # Preprocessing + OCR, streamed from the spooled upload file
+        ocr_tesseract, ocr_easyocr, ocr_paddle = await run_ocr_pipeline(image_file.file, tracker)
         combined_text = combine_ocr_results(ocr_tesseract, ocr_easyocr, ocr_paddle, tracker)
         
         if not combined_text:
             raise HTTPException(status_code=422, detail="OCR failed: No text could be extracted")
         
         # Prompt Preparation
-        tracker.update(4, "processing", "Loading and preparing prompt template...")
-        prompt_template = load_prompt()
-        final_prompt = prompt_template.replace("${ocr_text}", combined_text)
+        tracker.update(4, "processing", "Preparing prompt from template...")
+        final_prompt = build_prompt(combined_text)
         tracker.update(4, "success", f"Prompt prepared ({len(final_prompt)} characters)")
         
         # LLM Analysis
-        analyses = await process_models_parallel(base_url, selected_models, final_prompt, tracker)
+        analyses = await process_models_parallel(app.state.http, base_url, selected_models, final_prompt, tracker)
         
         successful_analyses = [a for a in analyses if a["error"] is None]
         
@@ -635,17 +1326,25 @@ async def ocr_check_sync(
             "raw_ocr_easyocr": ocr_easyocr,
             "raw_ocr_paddleocr": ocr_paddle,
             "llm_analyses": analyses,
-            "processing_time": round(time.time() - tracker.start_time, 2),
+            "processing_time": round(tracker.elapsed(), 2),
             "success_rate": f"{len(successful_analyses)}/{len(selected_models)}"
         }
         
-        return JSONResponse(response_data)
+        tracker.set_result(response_data)
+        return orjson_response(response_data)
         
-    except HTTPException:
+    except HTTPException as e:
+        tracker.set_error(str(e.detail))
         raise
     except Exception as e:
         tracker.update(6, "error", f"Unexpected error: {str(e)}")
+        tracker.set_error(str(e))
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # A client disconnect cancels the request without passing through the handlers above;
+        # the session still has to end so its Redis writer exits
+        if not tracker.is_finished():
+            tracker.set_error("Request cancelled")
 
 
 @app.on_event("startup")
@@ -654,7 +1353,72 @@ async def startup_event():
     logger.info("🚀 Turkish Check Analyzer API v3.0 starting up...")
     logger.info("✅ Real-time progress tracking enabled!")
 
+    try:
+        load_prompt_template(prompt_version())
+    except HTTPException as e:
+        logger.error(f"❌ Prompt template not usable: {e.detail}")
+
+    # Shared HTTP session so Ollama calls reuse pooled keep-alive connections
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=64, limit_per_host=16, keepalive_timeout=300)
+    )
+
+    app.state.progress_cleanup = asyncio.create_task(purge_progress_sessions())
+
+    if OLLAMA_PREWARM_MODELS:
+        # Runs in the background so startup doesn't wait for the models to load
+        app.state.ollama_prewarm = asyncio.create_task(
+            prewarm_ollama_models(app.state.http, OLLAMA_API_BASE_URL, OLLAMA_PREWARM_MODELS)
+        )
+
+    global redis_client
+    if REDIS_URL:
+        if aioredis is None:
+            logger.error("❌ REDIS_URL is set but the 'redis' package is not installed; using in-memory progress only")
+        else:
+            client = aioredis.from_url(REDIS_URL)
+            try:
+                await client.ping()
+                redis_client = client
+                logger.info("✅ Progress tracking shared through Redis")
+            except Exception as e:
+                logger.error(f"❌ Redis at {REDIS_URL} not reachable, using in-memory progress only: {e}")
+                await client.aclose()
+
+    # Start the OCR worker processes now so the first request doesn't pay for it
+    gpu = await detect_ocr_gpu()
+    OCR_POOLS.update(create_ocr_pools(gpu))
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(pool, os.getpid) for pool in set(OCR_POOLS.values())))
+    if easyocr_batcher is not None:
+        try:
+            await loop.run_in_executor(OCR_POOLS["easyocr"], warm_up_easyocr_batched, EASYOCR_BATCH_SIZE)
+        except Exception as e:
+            logger.warning(f"⚠️ EasyOCR batch warm-up failed: {e}")
+    device = "GPU" if gpu else "CPU"
+    logger.info(f"⚙️ OCR worker processes ready: {', '.join(OCR_POOLS)} (EasyOCR/PaddleOCR on {device})")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Application shutdown event."""
+    app.state.progress_cleanup.cancel()
+    if OLLAMA_PREWARM_MODELS:
+        app.state.ollama_prewarm.cancel()
+    if redis_client is not None:
+        await redis_client.aclose()
+    await app.state.http.close()
+    if easyocr_batcher is not None:
+        await easyocr_batcher.close()
+    for pool in set(OCR_POOLS.values()):
+        pool.shutdown(wait=False, cancel_futures=True)
+    OCR_POOLS.clear()
+
 
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level=LOG_LEVEL.lower())
\ No newline at end of file
+    # libuv event loop and C HTTP parser; uvloop is not available on Windows
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_level=LOG_LEVEL.lower(), loop=loop, http=http)
\ No newline at end of file
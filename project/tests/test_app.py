@@ -0,0 +1,440 @@
+import asyncio
+import io
+import json
+import os
+import signal
+import sys
+import types
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import numpy as np
+import orjson
+import pytest
+from PIL import Image
+from fastapi import HTTPException, UploadFile
+from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app
+
+
+class _FakeContent:
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            yield orjson.dumps(chunk) + b"\n"
+        if self.error is not None:
+            raise self.error
+
+
+class _FakeResponse:
+    def __init__(self, status=200, chunks=(), error=None, text=""):
+        self.status = status
+        self.content = _FakeContent(list(chunks), error)
+        self._text = text
+        self.closed = False
+
+    async def text(self):
+        return self._text
+
+    def close(self):
+        self.closed = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class _FakeSession:
+    """Hands out one scripted response, or raises one scripted exception, per POST."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def post(self, *args, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    monkeypatch.setattr(app, "OLLAMA_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(app, "OLLAMA_MAX_ATTEMPTS", 3)
+    app._ollama_semaphores.clear()
+    app._ollama_rate_limiters.clear()
+    return app.ProgressTracker("test-session")
+
+
+def _tokens(*pieces):
+    return [{"response": piece, "done": False} for piece in pieces]
+
+
+def generate(session, tracker):
+    return asyncio.run(app.request_ollama_generate(session, "http://ollama", "llama3", b"{}", tracker))
+
+
+def test_read_ollama_stream_stops_at_complete_json():
+    tokens = []
+    response = _FakeResponse(chunks=_tokens('Sure: {"iban": ', '"TR12"}', ' and more'))
+    text = asyncio.run(app.read_ollama_stream(response, on_token=tokens.append))
+    assert text == 'Sure: {"iban": "TR12"}'
+    assert tokens == ['Sure: {"iban": ', '"TR12"}']
+    assert response.closed
+
+
+def test_read_ollama_stream_raises_on_error_chunk():
+    response = _FakeResponse(chunks=[{"error": "model not found"}])
+    with pytest.raises(RuntimeError, match="model not found"):
+        asyncio.run(app.read_ollama_stream(response))
+
+
+def test_request_ollama_generate_retries_overloaded_server(tracker):
+    session = _FakeSession(
+        _FakeResponse(status=503, text="overloaded"),
+        _FakeResponse(chunks=_tokens('{"iban": "TR12"}')),
+    )
+    assert generate(session, tracker) == (200, '{"iban": "TR12"}')
+    assert session.calls == 2
+
+
+def test_request_ollama_generate_retries_connection_error_before_output(tracker):
+    session = _FakeSession(
+        aiohttp.ClientConnectionError("refused"),
+        _FakeResponse(chunks=_tokens('{"iban": "TR12"}')),
+    )
+    assert generate(session, tracker) == (200, '{"iban": "TR12"}')
+    assert session.calls == 2
+
+
+def test_request_ollama_generate_does_not_retry_timeouts(tracker):
+    session = _FakeSession(
+        _FakeResponse(chunks=_tokens('{"iban"'), error=aiohttp.ServerTimeoutError("stalled")),
+        _FakeResponse(chunks=_tokens('{"iban": "TR12"}')),
+    )
+    with pytest.raises(asyncio.TimeoutError):
+        generate(session, tracker)
+    assert session.calls == 1
+
+
+def test_request_ollama_generate_does_not_retry_after_output(tracker):
+    session = _FakeSession(
+        _FakeResponse(chunks=_tokens('{"iban"'), error=aiohttp.ServerDisconnectedError()),
+        _FakeResponse(chunks=_tokens('{"iban": "TR12"}')),
+    )
+    with pytest.raises(aiohttp.ClientConnectionError):
+        generate(session, tracker)
+    assert session.calls == 1
+
+
+@pytest.fixture
+def ocr_engines(monkeypatch):
+    """Run the OCR engines in threads with canned outputs, recording which were called."""
+    calls = []
+    outputs = {}
+
+    def engine(name):
+        def extract(image):
+            calls.append(name)
+            return outputs[name]
+        return extract
+
+    for name in ("tesseract", "easyocr", "paddleocr"):
+        monkeypatch.setattr(app, f"extract_text_{name}", engine(name))
+    pool = ThreadPoolExecutor(max_workers=3)
+    monkeypatch.setattr(app, "OCR_POOLS", {"tesseract": pool, "easyocr": pool, "paddleocr": pool})
+    monkeypatch.setattr(app, "easyocr_batcher", None)
+    monkeypatch.setattr(app, "OCR_STRATEGY", "fast")
+    yield calls, outputs
+    pool.shutdown()
+
+
+def test_run_ocr_parallel_skips_secondary_engines_when_tesseract_suffices(ocr_engines):
+    calls, outputs = ocr_engines
+    outputs["tesseract"] = "TR33 0006 1005 1978 6457 8413 26 ÇEK NO 0012345"
+    image = np.zeros((10, 10), dtype=np.uint8)
+    results = asyncio.run(app.run_ocr_parallel(image, app.ProgressTracker("ocr-fast")))
+    assert results == (outputs["tesseract"], None, None)
+    assert calls == ["tesseract"]
+
+
+def test_run_ocr_parallel_runs_secondary_engines_for_weak_tesseract_output(ocr_engines):
+    calls, outputs = ocr_engines
+    outputs.update(tesseract="ÇEK", easyocr="easy text", paddleocr="paddle text")
+    image = np.zeros((10, 10), dtype=np.uint8)
+    results = asyncio.run(app.run_ocr_parallel(image, app.ProgressTracker("ocr-weak")))
+    assert results == ("ÇEK", "easy text", "paddle text")
+    assert sorted(calls) == ["easyocr", "paddleocr", "tesseract"]
+
+
+def test_extract_json_object_keeps_wide_integers_exact():
+    wide = 123456789012345678901234567890
+    assert app.extract_json_object(f'{{"check_number": {wide}}}') == ({"check_number": wide}, False)
+    assert app.extract_json_object(f'Result: {{"check_number": {wide}}} done') == ({"check_number": wide}, True)
+
+
+def test_orjson_response_falls_back_for_wide_integers():
+    wide = 123456789012345678901234567890
+    response = app.orjson_response({"analysis": {"check_number": wide}, "logs": deque(["ok"])})
+    assert json.loads(response.body) == {"analysis": {"check_number": wide}, "logs": ["ok"]}
+
+
+def test_oversized_upload_rejected_from_content_length():
+    received = []
+
+    async def endpoint(scope, receive, send):
+        received.append(scope["path"])
+
+    client = TestClient(app.RequestSizeLimitMiddleware(endpoint, max_body_bytes=1024))
+    response = client.post(
+        "/api/ocr-check",
+        files={"image_file": ("check.png", b"\0" * 4096, "image/png")},
+        data={"selected_models_json": '["llama3"]'},
+    )
+    assert response.status_code == 413
+    assert response.json()["detail"].startswith("Request body too large")
+    assert received == []
+
+
+def test_request_size_limit_sits_inside_cors():
+    # The first entry is the outermost middleware
+    middleware = [entry.cls for entry in app.app.user_middleware]
+    assert middleware.index(app.CORSMiddleware) < middleware.index(app.RequestSizeLimitMiddleware)
+
+
+def _png_stream(width, height):
+    stream = io.BytesIO()
+    Image.new("L", (width, height)).save(stream, format="PNG")
+    stream.seek(0)
+    return stream
+
+
+def test_decompression_bomb_is_rejected_as_too_large(monkeypatch):
+    # Pillow refuses to open anything beyond twice its own limit
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    with pytest.raises(HTTPException) as excinfo:
+        app.validate_image_dimensions(_png_stream(100, 100))
+    assert excinfo.value.status_code == 413
+
+
+def test_unreadable_image_error_does_not_leak_file_repr():
+    with pytest.raises(HTTPException) as excinfo:
+        app.validate_image_dimensions(io.BytesIO(b"not an image"))
+    assert excinfo.value.status_code == 400
+    assert excinfo.value.detail == "Image could not be loaded"
+
+
+def test_run_in_ocr_pool_restarts_pool_after_worker_dies(monkeypatch):
+    monkeypatch.setattr(app, "TESSERACT_WORKERS", 1)
+    pool = app.create_ocr_pool("tesseract")
+    monkeypatch.setattr(app, "OCR_POOLS", {"tesseract": pool})
+
+    async def run():
+        worker_pid = await app.run_in_ocr_pool("tesseract", os.getpid)
+        os.kill(worker_pid, signal.SIGKILL)
+        return worker_pid, await app.run_in_ocr_pool("tesseract", os.getpid)
+
+    try:
+        dead_pid, new_pid = asyncio.run(run())
+        assert new_pid != dead_pid
+        assert app.OCR_POOLS["tesseract"] is not pool
+    finally:
+        for executor in set(app.OCR_POOLS.values()) | {pool}:
+            executor.shutdown()
+
+
+def test_replace_broken_ocr_pool_rebuilds_shared_gpu_pool_once(monkeypatch):
+    created = []
+    monkeypatch.setattr(app, "create_ocr_pool", lambda *engines, workers=1: created.append(engines) or ThreadPoolExecutor(1))
+    shared = ThreadPoolExecutor(1)
+    tesseract_pool = ThreadPoolExecutor(1)
+    monkeypatch.setattr(app, "OCR_POOLS", {"tesseract": tesseract_pool, "easyocr": shared, "paddleocr": shared})
+    app.replace_broken_ocr_pool(shared)
+    app.replace_broken_ocr_pool(shared)
+    assert created == [("easyocr", "paddleocr")]
+    assert app.OCR_POOLS["easyocr"] is app.OCR_POOLS["paddleocr"] is not shared
+    assert app.OCR_POOLS["tesseract"] is tesseract_pool
+    for executor in {app.OCR_POOLS["easyocr"], tesseract_pool}:
+        executor.shutdown()
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.aioredis.FakeRedis()
+    monkeypatch.setattr(app, "redis_client", client)
+    return client
+
+
+@pytest.fixture
+def other_worker(monkeypatch):
+    """Swap in an empty local progress store, as seen by a worker that doesn't own the session."""
+    def switch():
+        monkeypatch.setattr(app, "progress_storage", app.TTLCache(maxsize=16, ttl=60))
+    return switch
+
+
+async def _flush_redis_writes():
+    await asyncio.gather(*list(app._background_tasks))
+
+
+def test_get_progress_from_redis_keeps_wide_integers_exact(redis_client, other_worker):
+    wide = 123456789012345678901234567890
+
+    async def run():
+        tracker = app.ProgressTracker("wide-session")
+        tracker.update(6, "success", "done", {"check_number": wide})
+        tracker.set_result({"analysis": {"check_number": wide}})
+        await _flush_redis_writes()
+        other_worker()
+        return json.loads((await app.get_progress("wide-session")).body)
+
+    data = asyncio.run(run())
+    assert data["result"] == {"analysis": {"check_number": wide}}
+    assert data["logs"][0]["details"] == {"check_number": wide}
+
+
+def _sse_events(chunks):
+    return [json.loads(chunk[len(b"data: "):]) for chunk in chunks if chunk.startswith(b"data: ")]
+
+
+async def _collect_stream(session_id, accept_encoding=""):
+    request = types.SimpleNamespace(headers={"accept-encoding": accept_encoding})
+    response = await app.progress_stream(session_id, request)
+    return [chunk async for chunk in response.body_iterator]
+
+
+def test_redis_writer_mirrors_state_and_logs_in_order(redis_client):
+    async def run():
+        tracker = app.ProgressTracker("mirror-session")
+        for message in ("one", "two", "three"):
+            tracker.update(1, "info", message)
+        tracker.set_result({"ok": True})
+        writers = list(app._background_tasks)
+        # The final event ends the writer on its own
+        await asyncio.wait_for(asyncio.gather(*writers), timeout=5)
+        state = json.loads(await redis_client.get(app.redis_state_key("mirror-session")))
+        entries = await redis_client.xrange(app.redis_logs_key("mirror-session"))
+        return state, [json.loads(fields[b"data"]) for _, fields in entries]
+
+    state, logs = asyncio.run(run())
+    assert state["status"] == "completed"
+    assert state["result"] == {"ok": True}
+    assert "logs" not in state
+    assert [log.get("message") for log in logs] == ["one", "two", "three", None]
+    assert logs[-1] == {"status": "completed", "final": True}
+    assert not app._background_tasks
+
+
+def test_progress_from_another_worker_is_read_from_redis(redis_client, other_worker):
+    async def run():
+        tracker = app.ProgressTracker("remote-session")
+        tracker.update(1, "info", "one")
+        tracker.update(2, "info", "two")
+        tracker.set_error("boom")
+        await _flush_redis_writes()
+        other_worker()
+        progress = json.loads((await app.get_progress("remote-session")).body)
+        return progress, _sse_events(await _collect_stream("remote-session"))
+
+    progress, events = asyncio.run(run())
+    assert progress["status"] == "error"
+    assert progress["error"] == "boom"
+    assert [log["message"] for log in progress["logs"]] == ["one", "two"]
+    assert [event.get("message") for event in events] == ["one", "two", None]
+    assert events[-1] == {"status": "error", "final": True}
+
+
+def test_sync_endpoint_finishes_its_session_on_errors(redis_client):
+    upload = UploadFile(file=io.BytesIO(b"not an image"), filename="check.txt", headers=Headers({"content-type": "text/plain"}))
+
+    async def run():
+        with pytest.raises(HTTPException) as excinfo:
+            await app.ocr_check_sync(image_file=upload, selected_models_json='["llama3"]', ollama_url=None)
+        await asyncio.wait_for(_flush_redis_writes(), timeout=5)
+        session_ids = [key.decode().split(":")[1] async for key in redis_client.scan_iter("progress:*:state")]
+        states = [json.loads(await redis_client.get(app.redis_state_key(session_id))) for session_id in session_ids]
+        return excinfo.value, states
+
+    error, states = asyncio.run(run())
+    assert error.status_code == 400
+    assert [state["status"] for state in states] == ["error"]
+    assert not app._background_tasks
+
+
+def test_progress_stream_sends_backlog_then_live_events_and_unsubscribes():
+    async def run():
+        tracker = app.ProgressTracker("live-session")
+        tracker.update(1, "info", "before subscribing")
+        request = types.SimpleNamespace(headers={})
+        stream = (await app.progress_stream("live-session", request)).body_iterator
+        # The first event subscribes the stream and replays the backlog
+        chunks = [await stream.__anext__()]
+        assert len(app.progress_subscribers["live-session"]) == 1
+        tracker.update(2, "info", "while streaming")
+        tracker.set_result({"ok": True})
+        chunks += [chunk async for chunk in stream]
+        return _sse_events(chunks)
+
+    events = asyncio.run(run())
+    assert [event.get("message") for event in events] == ["before subscribing", "while streaming", None]
+    assert events[-1] == {"status": "completed", "final": True}
+    assert "live-session" not in app.progress_subscribers
+
+
+def test_progress_stream_for_finished_session_replays_backlog():
+    tracker = app.ProgressTracker("finished-session")
+    tracker.update(1, "info", "one")
+    tracker.set_result({"ok": True})
+    events = _sse_events(asyncio.run(_collect_stream("finished-session")))
+    assert events == [app.progress_storage["finished-session"]["logs"][0], {"status": "completed", "final": True}]
+    assert "finished-session" not in app.progress_subscribers
+
+
+def test_gzip_stream_output_decompresses_event_by_event():
+    events = [app.sse_event({"message": f"event {i}"}) for i in range(3)]
+
+    async def source():
+        for event in events:
+            yield event
+
+    async def run():
+        return [chunk async for chunk in app.gzip_stream(source())]
+
+    compressed = asyncio.run(run())
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    # Every event must be readable as soon as its own chunk arrives
+    assert [decompressor.decompress(chunk) for chunk in compressed[:-1]] == events
+    assert decompressor.decompress(compressed[-1]) == b""
+    assert decompressor.eof
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", True),
+    ("br;q=1.0, gzip;q=0.8", True),
+    ("GZIP", True),
+    ("*", True),
+    ("gzip;q=0", False),
+    ("gzip;q=0.0, *;q=1", False),
+    ("deflate, *;q=0", False),
+    ("identity", False),
+    ("", False),
+])
+def test_accepts_gzip_honours_q_values(header, expected):
+    assert app.accepts_gzip(header) is expected
@@ -1,7 +1,10 @@
+import asyncio
 import io
 import os
 import sys
 import types
+import cv2
+import numpy as np
 from PIL import Image
 import pytest
 
@@ -15,8 +18,21 @@ class _DummyReader:
 
 sys.modules.setdefault('easyocr', types.SimpleNamespace(Reader=_DummyReader))
 
-from utils.image_utils import preprocess_image
-from utils import ocr_utils
+from utils.batch_utils import MicroBatcher
+from utils.cache_utils import TTLCache
+from utils.image_utils import estimate_skew_angle, preprocess_image, read_image_size, read_stream_buffer
+from utils.rate_limit_utils import RateLimiter
+from utils import image_utils, ocr_utils
+
+
+@pytest.fixture(autouse=True)
+def clear_ocr_readers():
+    readers = (ocr_utils._get_tesseract_api, ocr_utils._get_easyocr_reader, ocr_utils._get_paddle_ocr)
+    for reader in readers:
+        reader.cache_clear()
+    yield
+    for reader in readers:
+        reader.cache_clear()
 
 
 def create_dummy_image_bytes() -> bytes:
@@ -26,13 +42,87 @@ def create_dummy_image_bytes() -> bytes:
     return b.getvalue()
 
 
-def test_preprocess_image_returns_image():
+def test_preprocess_image_returns_contiguous_array():
+    data = create_dummy_image_bytes()
+    result = preprocess_image(data)
+    assert isinstance(result, np.ndarray)
+    assert result.dtype == np.uint8
+    assert result.flags["C_CONTIGUOUS"]
+
+
+def test_read_image_size_rewinds_stream():
+    img = Image.new("RGB", (64, 32), color="white")
+    stream = io.BytesIO()
+    img.save(stream, format="PNG")
+    stream.seek(0)
+    assert read_image_size(stream) == (64, 32)
+    assert stream.tell() == 0
+
+
+def test_read_stream_buffer_reads_file_from_position(tmp_path):
+    path = tmp_path / "image.bin"
+    path.write_bytes(b"headerpayload")
+    with open(path, "rb") as fp:
+        fp.seek(6)
+        buffer = read_stream_buffer(fp)
+    assert buffer.dtype == np.uint8
+    assert buffer.tobytes() == b"payload"
+
+
+def test_preprocess_image_downscales_large_images():
+    img = Image.new("RGB", (400, 100), color="white")
+    b = io.BytesIO()
+    img.save(b, format="JPEG")
+    result = preprocess_image(b.getvalue(), max_side=200)
+    assert max(result.shape) == 200
+
+
+def test_preprocess_image_umat_path_matches_arrays(monkeypatch):
+    # cv2.UMat falls back to the CPU without an OpenCL device, so the path runs anywhere
     data = create_dummy_image_bytes()
+    expected = preprocess_image(data)
+    monkeypatch.setattr(image_utils, "USE_OPENCL", True)
     result = preprocess_image(data)
-    assert isinstance(result, Image.Image)
+    assert isinstance(result, np.ndarray)
+    assert np.array_equal(result, expected)
+
+
+def test_estimate_skew_angle_finds_text_rotation():
+    img = np.full((500, 1000), 230, dtype=np.uint8)
+    for i in range(6):
+        cv2.putText(img, "TR12 0006 1234 5678", (30, 60 + i * 75), cv2.FONT_HERSHEY_SIMPLEX, 1.5, 20, 3)
+    rotation = cv2.getRotationMatrix2D((500, 250), 3, 1.0)
+    skewed = cv2.warpAffine(img, rotation, (1000, 500), borderValue=230)
+    assert estimate_skew_angle(skewed) == pytest.approx(-3, abs=0.5)
+    assert estimate_skew_angle(np.full((100, 200), 255, dtype=np.uint8)) is None
+
+
+def test_estimate_skew_angle_without_long_lines_uses_text_lines():
+    img = np.full((500, 1000), 230, dtype=np.uint8)
+    for row in range(5):
+        for col in range(20):
+            x, y = 60 + col * 30, 120 + row * 60
+            cv2.rectangle(img, (x, y), (x + 12, y + 18), 20, -1)
+    rotation = cv2.getRotationMatrix2D((500, 250), 4, 1.0)
+    skewed = cv2.warpAffine(img, rotation, (1000, 500), borderValue=230)
+    assert estimate_skew_angle(skewed) == pytest.approx(-4, abs=0.5)
+
+
+@pytest.mark.parametrize("fields", [
+    [("No 0012345", (40, 80)), ("1.250,00 TL", (700, 80)), ("Garanti BBVA", (40, 900))],
+    [("No 0012345", (40, 80)), ("Garanti BBVA", (1500, 900))],
+])
+def test_estimate_skew_angle_leaves_straight_sparse_layout(fields):
+    img = np.full((1000, 2000), 230, dtype=np.uint8)
+    for text, origin in fields:
+        cv2.putText(img, text, origin, cv2.FONT_HERSHEY_SIMPLEX, 1.5, 20, 3)
+    half = cv2.resize(img, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    angle = estimate_skew_angle(half)
+    assert angle is None or abs(angle) < 0.3
 
 
 def test_extract_text_tesseract_success(monkeypatch):
+    monkeypatch.setattr(ocr_utils, "tesserocr", None)
     called = {}
     def fake_image_to_string(image, lang=None):
         called['lang'] = lang
@@ -45,6 +135,7 @@ def test_extract_text_tesseract_success(monkeypatch):
 
 
 def test_extract_text_tesseract_failure(monkeypatch):
+    monkeypatch.setattr(ocr_utils, "tesserocr", None)
     def fake_image_to_string(image, lang=None):
         raise ValueError('boom')
     monkeypatch.setattr(ocr_utils.pytesseract, "image_to_string", fake_image_to_string)
@@ -53,9 +144,26 @@ def test_extract_text_tesseract_failure(monkeypatch):
         ocr_utils.extract_text_tesseract(img)
 
 
+def test_extract_text_tesseract_uses_persistent_api(monkeypatch):
+    calls = []
+    class API:
+        def __init__(self, lang=None, oem=None):
+            calls.append(lang)
+        def SetImageBytes(self, data, width, height, bpp, bpl):
+            self.size = (width, height, bpp, bpl)
+        def GetUTF8Text(self):
+            return "%dx%d/%d/%d" % self.size
+    dummy_module = types.SimpleNamespace(PyTessBaseAPI=API, OEM=types.SimpleNamespace(LSTM_ONLY=1))
+    monkeypatch.setattr(ocr_utils, "tesserocr", dummy_module)
+    image = np.zeros((4, 6), dtype=np.uint8)
+    assert ocr_utils.extract_text_tesseract(image) == "6x4/1/6"
+    assert ocr_utils.extract_text_tesseract(image) == "6x4/1/6"
+    assert calls == ["tur+eng"]
+
+
 def test_extract_text_easyocr_success(monkeypatch):
     class Reader:
-        def __init__(self, langs, gpu=False):
+        def __init__(self, langs, gpu=False, **kwargs):
             pass
         def readtext(self, array):
             return [[None, 'text', None]]
@@ -67,6 +175,35 @@ def test_extract_text_easyocr_success(monkeypatch):
     assert text == 'text'
 
 
+def test_extract_text_easyocr_reuses_reader(monkeypatch):
+    created = []
+    class Reader:
+        def __init__(self, langs, gpu=False, **kwargs):
+            created.append(self)
+        def readtext(self, array):
+            return []
+    monkeypatch.setattr(ocr_utils, 'easyocr', types.SimpleNamespace(Reader=Reader))
+    img = Image.new("RGB", (10, 10))
+    ocr_utils.extract_text_easyocr(img)
+    ocr_utils.extract_text_easyocr(img)
+    assert len(created) == 1
+
+
+def test_easyocr_reader_falls_back_to_cpu(monkeypatch):
+    created = []
+    class Reader:
+        def __init__(self, langs, gpu=False, **kwargs):
+            if gpu:
+                raise RuntimeError("CUDA out of memory")
+            created.append(kwargs)
+        def readtext(self, array):
+            return []
+    monkeypatch.setattr(ocr_utils, 'easyocr', types.SimpleNamespace(Reader=Reader))
+    monkeypatch.setattr(ocr_utils, 'cuda_available', lambda: True)
+    assert ocr_utils.extract_text_easyocr(Image.new("RGB", (10, 10))) == ''
+    assert created == [{"quantize": True}]
+
+
 def test_extract_text_paddleocr_success(monkeypatch):
     class PaddleOCR:
         def __init__(self, *args, **kwargs):
@@ -83,6 +220,38 @@ def test_extract_text_paddleocr_success(monkeypatch):
     assert text == 'ptext'
 
 
+def test_paddleocr_is_imported_on_first_use(monkeypatch):
+    class PaddleOCR:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def ocr(self, array, cls=True):
+            return [[None, ("lazy", None)]]
+
+    monkeypatch.setattr(ocr_utils, 'PaddleOCR', None)
+    monkeypatch.setitem(sys.modules, 'paddleocr', types.SimpleNamespace(PaddleOCR=PaddleOCR))
+    assert ocr_utils.extract_text_paddleocr(Image.new("RGB", (10, 10))) == 'lazy'
+    assert ocr_utils.PaddleOCR is PaddleOCR
+
+
+def test_extract_text_paddleocr_reuses_instance(monkeypatch):
+    created = []
+
+    class PaddleOCR:
+        def __init__(self, *args, **kwargs):
+            created.append(kwargs)
+
+        def ocr(self, array, cls=True):
+            return []
+
+    monkeypatch.setattr(ocr_utils, 'PaddleOCR', PaddleOCR)
+    monkeypatch.setattr(ocr_utils, 'cuda_available', lambda: False)
+    ocr_utils.extract_text_paddleocr(Image.new("RGB", (10, 10)))
+    ocr_utils.extract_text_paddleocr(Image.new("RGB", (10, 10)))
+    assert len(created) == 1
+    assert created[0]["enable_mkldnn"] is True
+
+
 def test_extract_text_paddleocr_failure(monkeypatch):
     class PaddleOCR:
         def __init__(self, *args, **kwargs):
@@ -97,3 +266,74 @@ def test_extract_text_paddleocr_failure(monkeypatch):
     img = Image.new("RGB", (10, 10))
     with pytest.raises(RuntimeError):
         ocr_utils.extract_text_paddleocr(img)
+
+
+def test_ocr_shared_image_reads_from_shared_memory():
+    from multiprocessing import shared_memory
+    arr = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+    try:
+        shm.buf[:arr.nbytes] = arr.tobytes()
+        text = ocr_utils.ocr_shared_image(lambda image: str(image.sum()), shm.name, arr.shape, arr.dtype.str)
+    finally:
+        shm.close()
+        shm.unlink()
+    assert text == str(arr.sum())
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.items() == [("a", 1), ("c", 3)]
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.cache_utils.time.monotonic", lambda: now[0])
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    now[0] += 10
+    assert cache.get("a") is None
+    cache.set("b", 2)
+    now[0] += 10
+    assert cache.expire() == 1
+    assert len(cache) == 0
+
+
+def test_rate_limiter_spaces_out_calls(monkeypatch):
+    now = [100.0]
+    sleeps = []
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+    monkeypatch.setattr("utils.rate_limit_utils.time.monotonic", lambda: now[0])
+    monkeypatch.setattr("utils.rate_limit_utils.asyncio.sleep", fake_sleep)
+    limiter = RateLimiter(interval=2)
+
+    async def run():
+        for _ in range(3):
+            await limiter.wait()
+
+    asyncio.run(run())
+    assert sleeps == [2, 4]
+
+
+def test_micro_batcher_groups_concurrent_items():
+    batches = []
+    async def process(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(process, max_batch=3, max_wait=0.05)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        await batcher.close()
+        return results
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8]
+    assert batches == [[0, 1, 2], [3, 4]]
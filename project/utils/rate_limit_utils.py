@@ -0,0 +1,23 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """Space out operations so that at most one starts every ``interval`` seconds.
+
+    Callers reserve the next free start slot and sleep until it comes up, so waiting
+    callers are served in arrival order. Meant to be used from the asyncio event loop only.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_start = 0.0
+
+    async def wait(self) -> None:
+        if self.interval <= 0:
+            return
+        now = time.monotonic()
+        start = max(now, self._next_start)
+        self._next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)